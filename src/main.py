@@ -1,6 +1,6 @@
 import asyncio
 import os
-import sys
+import time
 import warnings
 import logging
 from dotenv import load_dotenv
@@ -16,14 +16,74 @@ load_dotenv(dotenv_path=dotenv_path)
 
 # Correct imports based on the ADK tutorial
 from sub_agents.bigquery.agent import build_bigquery_agent
+from tools import deadline
+from google.adk.agents.run_config import RunConfig, StreamingMode
 from google.adk.runners import Runner
 from google.adk.sessions import InMemorySessionService
 from google.genai import types as genai_types
 
 # --- Control for showing reasoning process ---
 SHOW_REASONING = os.getenv("SHOW_REASONING", "False").lower() in ("true", "1", "t")
+# --- Control for streaming the final answer as it is generated ---
+STREAM_OUTPUT = os.getenv("STREAM_OUTPUT", "False").lower() in ("true", "1", "t")
+
+def configure_logging():
+    """Keeps library and tool diagnostics off the terminal unless SHOW_REASONING is set."""
+    logging.basicConfig(level=logging.ERROR, format="%(levelname)s %(name)s: %(message)s")
+    app_level = logging.INFO if SHOW_REASONING else logging.ERROR
+    for name in ("sub_agents", "tools"):
+        logging.getLogger(name).setLevel(app_level)
+    for name in ("google_adk", "google_genai", "httpx", "urllib3"):
+        logging.getLogger(name).setLevel(logging.CRITICAL)
+
+def _event_text(event):
+    if event.content and event.content.parts and event.content.parts[0].text:
+        return event.content.parts[0].text
+    return None
+
+async def stream_final_answer(runner, user_id, session_id, user_message):
+    """Prints answer tokens as they arrive and reports time-to-first-token and total time."""
+    run_config = RunConfig(streaming_mode=StreamingMode.SSE)
+    start = time.perf_counter()
+    first_token_time = None
+    final_response_time = None
+    streamed = False
+    final_response = "Agent did not produce a final response."
+
+    print("\n--- Final Answer ---")
+    async for event in runner.run_async(
+        user_id=user_id, session_id=session_id, new_message=user_message, run_config=run_config
+    ):
+        text = _event_text(event)
+        if event.partial:
+            if text:
+                if first_token_time is None:
+                    first_token_time = time.perf_counter()
+                    print("<<< Agent Response: ", end="", flush=True)
+                print(text, end="", flush=True)
+                streamed = True
+            continue
+        if streamed and event.get_function_calls():
+            # Text streamed before a tool call was not the final answer.
+            print("\n", flush=True)
+            first_token_time = None
+            streamed = False
+        if event.is_final_response() and text:
+            final_response = text.strip()
+            final_response_time = time.perf_counter()
+
+    total_time = time.perf_counter() - start
+    if streamed:
+        print()
+    else:
+        # The model or transport did not stream; the first token arrived with the aggregated answer.
+        first_token_time = final_response_time or start + total_time
+        print(f"<<< Agent Response: {final_response}")
+    print(f"\n[time to first token: {first_token_time - start:.2f}s, total time: {total_time:.2f}s]")
 
 async def main():
+    configure_logging()
+
     # --- 1. Get the User's Question ---
     question = os.getenv("QUESTION")
     if not question:
@@ -49,6 +109,9 @@ async def main():
     user_message = genai_types.Content(role="user", parts=[genai_types.Part(text=question)])
 
     # --- 4. Run the Agent ---
+    # One deadline for the whole question (QUESTION_DEADLINE_SECONDS), shared by
+    # schema loading, SQL generation and correction, dry runs and execution.
+    deadline.start()
     final_response = "Agent did not produce a final response."
 
     if SHOW_REASONING:
@@ -69,24 +132,16 @@ async def main():
             if event.is_final_response() and event.content and event.content.parts:
                 if event.content.parts[0].text:
                     final_response = event.content.parts[0].text.strip()
+    elif STREAM_OUTPUT:
+        await stream_final_answer(runner, user_id, session_id_str, user_message)
+        return
     else:
-        original_stdout = sys.stdout
-        original_stderr = sys.stderr
-        sys.stdout = open(os.devnull, 'w')
-        sys.stderr = open(os.devnull, 'w')
-        
-        try:
-            async for event in runner.run_async(
-                user_id=user_id, session_id=session_id_str, new_message=user_message
-            ):
-                if event.is_final_response() and event.content and event.content.parts:
-                    if event.content.parts[0].text:
-                        final_response = event.content.parts[0].text.strip()
-        finally:
-            sys.stdout.close()
-            sys.stderr.close()
-            sys.stdout = original_stdout
-            sys.stderr = original_stderr
+        async for event in runner.run_async(
+            user_id=user_id, session_id=session_id_str, new_message=user_message
+        ):
+            if event.is_final_response() and event.content and event.content.parts:
+                if event.content.parts[0].text:
+                    final_response = event.content.parts[0].text.strip()
 
     # --- 5. Print the Final Result ---
     print("\n--- Final Answer ---")
@@ -1,28 +1,92 @@
 import os
 from google.adk.agents import Agent
+from google.adk.agents.callback_context import CallbackContext
 from google.genai import types
 
 # Import the new and updated tools
-from . import tools
+from tools import deadline
+from . import settings, tools
 
 # Read the method from environment variable, defaulting to BASELINE
 NL2SQL_METHOD = os.getenv("NL2SQL_METHOD", "BASELINE")
 
+# FAST_PATH answers typical questions with a single fused tool call.
+FAST_PATH = os.getenv("FAST_PATH", "False").lower() in ("true", "1", "t")
+
+def setup_before_agent_call(callback_context: CallbackContext):
+    """Starts loading database_settings (schema, project, dataset, CHASE options) in the background.
+
+    Returns immediately, so the first model turn runs while the schema loads.
+    Tools that need the settings wait for the prefetch only if it is still running.
+    Also starts the question deadline (QUESTION_DEADLINE_SECONDS) unless the caller set one.
+    """
+    deadline.ensure(callback_context.invocation_id)
+    settings.start_warm_start(callback_context.state)
+
+
 def build_bigquery_agent():
     """Builds the BigQuery agent with its tools and setup callbacks."""
-    
-    # The initial_sql_tool is now the same for both methods
-    initial_sql_tool = tools.initial_bq_nl2sql
+
+    if NL2SQL_METHOD == "CHASE":
+        # Imported lazily: the CHASE tools initialize Vertex AI on import.
+        from .chase_sql import chase_db_tools
+        initial_sql_tool = chase_db_tools.initial_bq_nl2sql
+        nl2sql_step = "Use the `initial_bq_nl2sql` tool with the question to generate a SQL query. The schema is loaded automatically."
+    else:
+        initial_sql_tool = tools.initial_bq_nl2sql
+        nl2sql_step = "Use the `initial_bq_nl2sql` tool to generate a SQL query. Pass the schema handle, never the DDL text itself."
+
+    default_dataset_id = os.getenv("BQ_DATASET_ID")
+    if default_dataset_id:
+        preloaded_note = (
+            f"The schema of the `{default_dataset_id}` dataset is preloaded under the handle "
+            f"`{settings.schema_handle_for([default_dataset_id])}`; for questions about it you can skip steps 1 and 2."
+        )
+    else:
+        preloaded_note = ""
+
+    result_tools_note = (
+        "Query results come with a result handle. For follow-ups on a result (top N, filtering, sorting, "
+        "grouping by a column or by day/month/year), use `page_result`, `filter_result`, `sort_result` and "
+        "`aggregate_result` on its handle instead of querying BigQuery again."
+    )
+
+    if tools.PROGRESSIVE_MIN_BYTES:
+        result_tools_note += (
+            "\nLarge queries may return a PROVISIONAL RESULT computed from a sample while the exact query runs. "
+            "Give the user the directional answer right away, saying it is provisional, then call "
+            "`get_exact_result` with its handle (and `wait_seconds` if the user wants to wait) for the final figures."
+        )
+    if tools.APPROXIMATE_AGGREGATES:
+        result_tools_note += (
+            "\nFor exploratory questions that only need rough figures (\"roughly\", \"about\", \"approximately\"), "
+            "pass `approximate=True` to run distinct counts, percentiles and top-k counts approximately. "
+            "When a result is marked APPROXIMATE RESULT, say that the figures are approximate."
+        )
 
     # New instructions for the agent
-    base_instructions = """You are a BigQuery expert. Your goal is to answer user questions by writing and executing SQL queries.
+    base_instructions = f"""You are a BigQuery expert. Your goal is to answer user questions by writing and executing SQL queries.
 
 Here is your workflow:
 1.  Use the `list_bq_datasets` tool to find available datasets.
-2.  Use the `get_schema_for_datasets` tool to get the schema for relevant dataset(s).
-3.  Use the `initial_bq_nl2sql` tool to generate a SQL query.
+2.  Use the `get_schema_for_datasets` tool to get the schema for relevant dataset(s). It returns a schema handle.
+3.  {nl2sql_step}
 4.  Use the `validate_and_execute_query` tool to run the SQL and get the answer.
+{preloaded_note}
+{result_tools_note}
+"""
+
+    fast_path_instructions = f"""You are a BigQuery expert. Your goal is to answer user questions with data from BigQuery.
+
+Here is your workflow:
+1.  Call the `answer_question` tool once with the user's question, rewritten to be self-contained if needed. It finds the dataset, generates and runs the SQL, and returns the SQL with its results.
+2.  Answer the user from those results.
+{result_tools_note}
+
+Only fall back to the other tools if `answer_question` returns an error or its results do not answer the question.
 """
+    if FAST_PATH:
+        base_instructions = fast_path_instructions
 
     # Get guidance from environment variable
     guidance = os.getenv("AGENT_GUIDANCE")
@@ -31,16 +95,26 @@ Here is your workflow:
     else:
         instructions = base_instructions
 
+    agent_tools = [
+        initial_sql_tool,
+        tools.validate_and_execute_query,
+        tools.list_bq_datasets,
+        tools.get_schema_for_datasets,
+        tools.page_result,
+        tools.filter_result,
+        tools.sort_result,
+        tools.aggregate_result,
+    ]
+    if tools.PROGRESSIVE_MIN_BYTES:
+        agent_tools.append(tools.get_exact_result)
+    if FAST_PATH:
+        agent_tools.insert(0, tools.answer_question)
+
     return Agent(
         model=os.getenv("BIGQUERY_AGENT_MODEL"),
         name="database_agent",
         instruction=instructions,
-        tools=[
-            initial_sql_tool,
-            tools.validate_and_execute_query,
-            tools.list_bq_datasets,
-            tools.get_schema_for_datasets,
-        ],
-        # No longer need the before_agent_callback
+        tools=agent_tools,
+        before_agent_callback=setup_before_agent_call,
         generate_content_config=types.GenerateContentConfig(temperature=0.0),
     )
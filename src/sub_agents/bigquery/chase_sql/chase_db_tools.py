@@ -15,13 +15,17 @@
 """This code contains the implementation of the tools used for the CHASE-SQL agent."""
 
 import enum
+import logging
+import math
 import os
 
 from google.adk.tools import ToolContext
+from tools import cascade, complexity, ensemble
 
 # pylint: disable=g-importing-member
+from ..settings import COMPLEXITY_SIGNATURE_KEY, ensure_database_settings
 from .dc_prompt_template import DC_PROMPT_TEMPLATE
-from .llm_utils import GeminiModel
+from .llm_utils import TIMEOUT_RESPONSE, GeminiModel
 from .qp_prompt_template import QP_PROMPT_TEMPLATE
 from .sql_postprocessor import sql_translator
 
@@ -29,16 +33,20 @@ from .sql_postprocessor import sql_translator
 
 BQ_DATA_PROJECT_ID = os.getenv("BQ_DATA_PROJECT_ID")
 
+logger = logging.getLogger(__name__)
+
 
 class GenerateSQLType(enum.Enum):
     """Enum for the different types of SQL generation methods.
 
     DC: Divide and Conquer ICL prompting
     QP: Query Plan-based prompting
+    ENSEMBLE: DC and QP candidates, picked by a vote on their sampled results
     """
 
     DC = "dc"
     QP = "qp"
+    ENSEMBLE = "ensemble"
 
 
 def exception_wrapper(func):
@@ -74,78 +82,152 @@ def parse_response(response: str) -> str:
         if "```sql" in response and "```" in response:
             query = response.split("```sql")[1].split("```")[0]
     except ValueError as e:
-        print(f"Error in parsing response: {e}")
+        logger.warning("Error in parsing response: %s", e)
         query = response
     return query.strip()
 
 
-def initial_bq_nl2sql(
-    question: str,
-    tool_context: ToolContext,
+def _prompt(generate_sql_type: str, ddl_schema: str, question: str) -> str:
+    """Formats the DC or QP prompt for the question."""
+    if generate_sql_type == GenerateSQLType.DC.value:
+        template = DC_PROMPT_TEMPLATE
+    elif generate_sql_type == GenerateSQLType.QP.value:
+        template = QP_PROMPT_TEMPLATE
+    else:
+        raise ValueError(f"Unsupported generate_sql_type: {generate_sql_type}")
+    return template.format(
+        SCHEMA=ddl_schema,
+        QUESTION=question,
+        BQ_DATA_PROJECT_ID=BQ_DATA_PROJECT_ID
+    )
+
+
+def _generate_sql(
+    model_name: str,
+    prompts: list[str],
+    database_settings: dict,
+    user_id: str = "default",
 ) -> str:
-    """Generates an initial SQL query from a natural language question.
+    """Generates the SQL candidates with one model.
 
     Args:
-      question: Natural language question.
-      tool_context: Function context.
+      model_name: The Gemini model to generate with.
+      prompts: The prompts to generate `number_of_candidates` candidates of
+        each, concurrently.
+      database_settings: The session's database settings.
+      user_id: The user charged for the ensemble probes.
 
     Returns:
-      str: An SQL statement to answer this question.
+      str: The candidate to run, transpiled to BigQuery if
+      `transpile_to_bigquery` is set. When several candidates finished in time,
+      the ensemble vote picks it (without probes if they are all the same query).
+
+    Raises:
+      TimeoutError: If no candidate finished in time.
     """
-    print("****** Running agent with ChaseSQL algorithm.")
-    ddl_schema = tool_context.state["database_settings"]["bq_ddl_schema"]
-    project = tool_context.state["database_settings"]["bq_data_project_id"]
-    db = tool_context.state["database_settings"]["bq_dataset_id"]
-    transpile_to_bigquery = tool_context.state["database_settings"][
-        "transpile_to_bigquery"
-    ]
-    process_input_errors = tool_context.state["database_settings"][
-        "process_input_errors"
-    ]
-    process_tool_output_errors = tool_context.state["database_settings"][
-        "process_tool_output_errors"
+    temperature = database_settings["temperature"]
+    model = GeminiModel(model_name=model_name, temperature=temperature)
+    requests = [
+        prompt for prompt in prompts for _ in range(database_settings["number_of_candidates"])
     ]
-    number_of_candidates = tool_context.state["database_settings"][
-        "number_of_candidates"
-    ]
-    model = tool_context.state["database_settings"]["model"]
-    temperature = tool_context.state["database_settings"]["temperature"]
-    generate_sql_type = tool_context.state["database_settings"]["generate_sql_type"]
-
-    if generate_sql_type == GenerateSQLType.DC.value:
-        prompt = DC_PROMPT_TEMPLATE.format(
-            SCHEMA=ddl_schema,
-            QUESTION=question,
-            BQ_DATA_PROJECT_ID=BQ_DATA_PROJECT_ID
-        )
-    elif generate_sql_type == GenerateSQLType.QP.value:
-        prompt = QP_PROMPT_TEMPLATE.format(
-            SCHEMA=ddl_schema,
-            QUESTION=question,
-            BQ_DATA_PROJECT_ID=BQ_DATA_PROJECT_ID
-        )
-    else:
-        raise ValueError(f"Unsupported generate_sql_type: {generate_sql_type}")
-
-    model = GeminiModel(model_name=model, temperature=temperature)
-    requests = [prompt for _ in range(number_of_candidates)]
-    responses = model.call_parallel(requests, parser_func=parse_response)
-    # Take just the first response.
-    responses = responses[0]
+    responses = model.call_parallel(
+        requests,
+        parser_func=parse_response,
+        stop_after_sql_block=database_settings.get("stop_after_sql_block", False),
+    )
+    finished = [response for response in responses if response != TIMEOUT_RESPONSE]
+    if not finished:
+        raise TimeoutError(f"no SQL candidate from {model_name} finished in time")
 
     # If postprocessing of the SQL to transpile it to BigQuery is required,
     # then do it here.
-    if transpile_to_bigquery:
+    if database_settings["transpile_to_bigquery"]:
         translator = sql_translator.SqlTranslator(
             model=model,
             temperature=temperature,
-            process_input_errors=process_input_errors,
-            process_tool_output_errors=process_tool_output_errors,
+            process_input_errors=database_settings["process_input_errors"],
+            process_tool_output_errors=database_settings["process_tool_output_errors"],
         )
         # pylint: disable=g-bad-todo
         # pylint: enable=g-bad-todo
-        responses: str = translator.translate(
-            responses, ddl_schema=ddl_schema, db=db, catalog=project
+        finished = [
+            translator.translate(
+                response,
+                ddl_schema=database_settings["bq_ddl_schema"],
+                db=database_settings["bq_dataset_id"],
+                catalog=database_settings["bq_data_project_id"],
+            )
+            for response in finished
+        ]
+
+    if len(finished) == 1:
+        return finished[0]
+    responses, _ = ensemble.vote(finished, user_id)
+    return responses
+
+
+def initial_bq_nl2sql(
+    question: str,
+    tool_context: ToolContext,
+) -> str:
+    """Generates an initial SQL query from a natural language question.
+
+    With `cascade_model` set (CHASE_CASCADE_MODEL), that model is tried first and
+    the question only escalates to `model` when its query fails the schema check
+    or the dry run. With `adaptive_candidates` set, the number of candidates and
+    the generation type follow the estimated complexity of the question. The
+    "ensemble" generation type generates DC and QP candidates together and runs
+    the one whose result most candidates agree on (see tools/ensemble.py).
+
+    Args:
+      question: Natural language question.
+      tool_context: Function context.
+
+    Returns:
+      str: An SQL statement to answer this question.
+    """
+    logger.info("Running agent with ChaseSQL algorithm.")
+    # Waits for the warm-start prefetch only if it has not finished yet.
+    try:
+        database_settings = ensure_database_settings(tool_context.state)
+    except TimeoutError as e:
+        return f"Error: the schema did not load in time ({e})."
+    ddl_schema = database_settings["bq_ddl_schema"]
+    model = database_settings["model"]
+    cascade_model = database_settings.get("cascade_model")
+    generate_sql_type = database_settings["generate_sql_type"]
+
+    if database_settings.get("adaptive_candidates"):
+        estimate = complexity.estimate(question, ddl_schema)
+        number_of_candidates, generate_sql_type = complexity.plan_generation(
+            estimate, database_settings["max_candidates"], generate_sql_type
         )
+        logger.info("%s: %d candidate(s), %s", estimate, number_of_candidates, generate_sql_type)
+        database_settings = {**database_settings, "number_of_candidates": number_of_candidates}
+        tool_context.state[COMPLEXITY_SIGNATURE_KEY] = estimate.signature
+
+    if generate_sql_type == GenerateSQLType.ENSEMBLE.value:
+        prompts = [
+            _prompt(GenerateSQLType.DC.value, ddl_schema, question),
+            _prompt(GenerateSQLType.QP.value, ddl_schema, question),
+        ]
+        # number_of_candidates is the total, split between the two methods.
+        per_method = max(1, math.ceil(database_settings["number_of_candidates"] / 2))
+        database_settings = {**database_settings, "number_of_candidates": per_method}
+    else:
+        prompts = [_prompt(generate_sql_type, ddl_schema, question)]
+    user_id = getattr(tool_context, "user_id", None) or "default"
 
-    return responses
+    def generate(model_name):
+        return lambda usage: _generate_sql(model_name, prompts, database_settings, user_id)
+
+    try:
+        if not cascade_model:
+            return generate(model)(None)
+        return cascade.generate(
+            (cascade_model, generate(cascade_model)),
+            (model, generate(model)),
+            lambda sql: cascade.escalation_reason(sql, ddl_schema),
+        )
+    except TimeoutError as e:
+        return f"Error: SQL generation did not finish in time ({e}). Ask the user to narrow the question."
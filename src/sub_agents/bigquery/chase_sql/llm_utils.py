@@ -14,9 +14,13 @@
 
 """This code contains the LLM utils for the CHASE-SQL Agent."""
 
+import collections
+import contextvars
 import functools
+import logging
 import os
 import random
+import threading
 import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Callable, List, Optional
@@ -29,8 +33,12 @@ from vertexai.generative_models import (GenerationConfig, HarmBlockThreshold,
 from vertexai.preview import caching
 from vertexai.preview.generative_models import GenerativeModel
 
+from tools import deadline, llm_cache
+
 dotenv.load_dotenv(override=True)
 
+logger = logging.getLogger(__name__)
+
 SAFETY_FILTER_CONFIG = {
     HarmCategory.HARM_CATEGORY_UNSPECIFIED: HarmBlockThreshold.BLOCK_NONE,
     HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
@@ -79,14 +87,141 @@ aiplatform.init(
 )
 vertexai.init(project=GCP_PROJECT, location=GCP_LOCATION)
 
-def retry(max_attempts=3, base_delay=1, backoff_factor=2):
+# HTTP status codes of transient errors; everything else fails without a retry.
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# After this many consecutive transient failures of a model, calls to it fail
+# fast for LLM_CIRCUIT_RESET_SECONDS before a single trial call is let through.
+LLM_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("LLM_CIRCUIT_FAILURE_THRESHOLD", "5"))
+LLM_CIRCUIT_RESET_SECONDS = float(os.getenv("LLM_CIRCUIT_RESET_SECONDS", "30"))
+
+# Process-wide retry counters: `attempts`, `retries`, `retry_after_hints`,
+# `fatal_errors`, `retries_exhausted`, `deadline_stops` and `circuit_open`.
+RETRY_STATS: collections.Counter[str] = collections.Counter()
+
+
+def get_retry_stats() -> dict[str, int]:
+    """Returns a snapshot of the retry counters."""
+    return dict(RETRY_STATS)
+
+
+# call_parallel's placeholder for calls that had not finished by the timeout.
+TIMEOUT_RESPONSE = "Timeout"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a model whose circuit breaker is open."""
+
+
+def _status_code(error: Exception) -> int | None:
+    # google.api_core exceptions carry the HTTP status in `code`; gRPC status
+    # codes are mapped to it as well (e.g. RESOURCE_EXHAUSTED -> 429).
+    code = getattr(error, "code", None)
+    return code if isinstance(code, int) else None
+
+
+def is_retryable(error: Exception) -> bool:
+    """True for transient errors: rate limits, server errors and timeouts.
+
+    Invalid arguments, safety blocks, parse failures, an open circuit and an
+    exhausted question deadline are fatal.
+    """
+    if isinstance(error, (deadline.DeadlineExceeded, CircuitOpenError)):
+        return False
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    return _status_code(error) in RETRYABLE_STATUS_CODES
+
+
+def retry_after(error: Exception) -> float | None:
+    """Returns the delay in seconds the server asked for, if any.
+
+    Reads the Retry-After header of HTTP errors and the RetryInfo detail of gRPC
+    errors.
+    """
+    response = getattr(error, "response", None)
+    value = getattr(response, "headers", {}).get("Retry-After") if response is not None else None
+    if value is not None:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    for detail in getattr(error, "details", None) or []:
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None:
+            return delay.seconds + delay.nanos / 1e9
+    return None
+
+
+class CircuitBreaker:
+    """Fails calls fast while a model keeps returning transient errors."""
+
+    def __init__(self, name, failure_threshold, reset_seconds):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raises CircuitOpenError while the circuit is open."""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_seconds or self._trial_running:
+                RETRY_STATS["circuit_open"] += 1
+                raise CircuitOpenError(f"Circuit open for model {self.name} after {self._failures} failures.")
+            # Half open: let one trial call through.
+            self._trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures, self._opened_at, self._trial_running = 0, None, False
+
+    def record_failure(self, error):
+        if not is_retryable(error):
+            # A bad prompt says nothing about the model's health, but it ends a trial call.
+            with self._lock:
+                self._trial_running = False
+            return
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning("Opening circuit for model %s after %d failures", self.name, self._failures)
+                self._opened_at = time.monotonic()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def circuit_breaker(model_name: str) -> CircuitBreaker:
+    """Returns the process-wide circuit breaker of a model."""
+    with _breakers_lock:
+        if model_name not in _breakers:
+            _breakers[model_name] = CircuitBreaker(
+                model_name, LLM_CIRCUIT_FAILURE_THRESHOLD, LLM_CIRCUIT_RESET_SECONDS
+            )
+        return _breakers[model_name]
+
+
+def retry(max_attempts=3, base_delay=1, backoff_factor=2, max_delay=60):
     """Decorator to add retry logic to a function.
 
+    Only transient errors (see `is_retryable`) are retried; the server's
+    retry-after hint replaces the backoff when there is one. No retry is
+    attempted once its delay would outlast the question deadline.
+
     Args:
         max_attempts (int): The maximum number of attempts.
         base_delay (int): The base delay in seconds for the exponential backoff.
         backoff_factor (int): The factor by which to multiply the delay for each
           subsequent attempt.
+        max_delay (int): The longest delay in seconds between two attempts.
 
     Returns:
         Callable: The decorator function.
@@ -97,15 +232,31 @@ def retry(max_attempts=3, base_delay=1, backoff_factor=2):
         def wrapper(*args, **kwargs):
             attempts = 0
             while attempts < max_attempts:
+                RETRY_STATS["attempts"] += 1
                 try:
                     return func(*args, **kwargs)
                 except Exception as e:  # pylint: disable=broad-exception-caught
-                    print(f"Attempt {attempts + 1} failed with error: {e}")
                     attempts += 1
+                    if not is_retryable(e):
+                        RETRY_STATS["fatal_errors"] += 1
+                        logger.warning("Attempt %d failed with a non-retryable error: %s", attempts, e)
+                        raise e
+                    logger.warning("Attempt %d failed with error: %s", attempts, e)
                     if attempts >= max_attempts:
+                        RETRY_STATS["retries_exhausted"] += 1
                         raise e
-                    delay = base_delay * (backoff_factor**attempts)
-                    delay = delay + random.uniform(0, 0.1 * delay)
+                    delay = retry_after(e)
+                    if delay is not None:
+                        RETRY_STATS["retry_after_hints"] += 1
+                    else:
+                        delay = min(base_delay * (backoff_factor**attempts), max_delay)
+                        delay = delay + random.uniform(0, 0.1 * delay)
+                    remaining = deadline.remaining()
+                    if remaining is not None and delay >= remaining:
+                        RETRY_STATS["deadline_stops"] += 1
+                        logger.warning("Not retrying: %.1fs left before the question deadline", remaining)
+                        raise e
+                    RETRY_STATS["retries"] += 1
                     time.sleep(delay)
 
         return wrapper
@@ -113,6 +264,68 @@ def retry(max_attempts=3, base_delay=1, backoff_factor=2):
     return decorator
 
 
+class SqlBlockDetector:
+    """Incrementally detects the end of the first ```sql block in streamed text.
+
+    The DC and QP prompts ask for the final query as the only ```sql block, so
+    nothing after its closing fence is needed. The detector only scans the new
+    part of the buffer on every chunk.
+    """
+
+    OPEN_FENCE = "```sql"
+    CLOSE_FENCE = "```"
+
+    def __init__(self):
+        self._buffer = ""
+        self._scan_from = 0
+        self._block_start: int | None = None
+        self.complete = False
+
+    @property
+    def text(self) -> str:
+        """The text received so far."""
+        return self._buffer
+
+    def feed(self, chunk: str) -> bool:
+        """Adds a chunk of streamed text.
+
+        Args:
+            chunk (str): The newly received text.
+
+        Returns:
+            bool: True once the closing fence of the ```sql block was received.
+        """
+        if self.complete:
+            return True
+        self._buffer += chunk
+        if self._block_start is None:
+            index = self._buffer.find(self.OPEN_FENCE, self._scan_from)
+            if index < 0:
+                # A fence may be split across chunks; rescan its possible prefix.
+                self._scan_from = max(0, len(self._buffer) - len(self.OPEN_FENCE))
+                return False
+            self._block_start = index + len(self.OPEN_FENCE)
+            self._scan_from = self._block_start
+        index = self._buffer.find(self.CLOSE_FENCE, self._scan_from)
+        if index < 0:
+            self._scan_from = max(
+                self._block_start, len(self._buffer) - len(self.CLOSE_FENCE)
+            )
+            return False
+        # Drop anything that arrived after the closing fence.
+        self._buffer = self._buffer[: index + len(self.CLOSE_FENCE)]
+        self.complete = True
+        return True
+
+
+def _chunk_text(chunk) -> str:
+    """Returns the text of a streamed response chunk, or "" for chunks without text."""
+    try:
+        return chunk.text
+    except ValueError:  # e.g. a final chunk that only carries the finish reason.
+        return ""
+
+
 class GeminiModel:
     """Class for the Gemini model."""
 
@@ -130,6 +343,7 @@ class GeminiModel:
         self.arguments = kwargs
         self.distribute_requests = distribute_requests
         self.temperature = temperature
+        self.cache_name = cache_name
         model_name = self.model_name
         if not self.finetuned_model and self.distribute_requests:
             random_region = random.choice(GEMINI_AVAILABLE_REGIONS)
@@ -146,8 +360,44 @@ class GeminiModel:
         else:
             self.model = GenerativeModel(model_name=model_name)
 
-    @retry(max_attempts=12, base_delay=2, backoff_factor=2)
-    def call(self, prompt: str, parser_func=None) -> str:
+    def _stream_until_sql_block(
+        self, prompt: str, generation_config: GenerationConfig
+    ) -> str:
+        """Streams the response and stops as soon as the ```sql block is closed.
+
+        Args:
+            prompt (str): The prompt to call the model with.
+            generation_config (GenerationConfig): The generation config.
+
+        Returns:
+            str: The response text up to and including the closing fence, or the
+            whole response if it has no ```sql block.
+        """
+        detector = SqlBlockDetector()
+        stream = self.model.generate_content(
+            prompt,
+            generation_config=generation_config,
+            safety_settings=SAFETY_FILTER_CONFIG,
+            stream=True,
+        )
+        try:
+            for chunk in stream:
+                if detector.feed(_chunk_text(chunk)):
+                    break
+        finally:
+            # Closing the stream cancels the rest of the generation.
+            if hasattr(stream, "close"):
+                stream.close()
+        return detector.text
+
+    @retry(max_attempts=12, base_delay=2, backoff_factor=2, max_delay=60)
+    def call(
+        self,
+        prompt: str,
+        parser_func=None,
+        stop_after_sql_block: bool = False,
+        cache: bool | None = None,
+    ) -> str:
         """Calls the Gemini model with the given prompt.
 
         Args:
@@ -155,18 +405,51 @@ class GeminiModel:
             parser_func (callable, optional): A function that processes the LLM
               output. It takes the model"s response as input and returns the
               processed result.
+            stop_after_sql_block (bool): If True, the response is streamed and the
+              generation is stopped once the first ```sql block is complete.
+            cache (bool, optional): Whether the response may be served from and
+              stored in the LLM response cache. Defaults to True only at
+              temperature 0, so sampled candidates stay distinct.
 
         Returns:
             str: The processed response from the model.
         """
-        response = self.model.generate_content(
-            prompt,
-            generation_config=GenerationConfig(
-                temperature=self.temperature,
+        generation_config = GenerationConfig(
+            temperature=self.temperature,
+            **self.arguments,
+        )
+
+        def generate() -> str:
+            breaker = circuit_breaker(self.model_name)
+            breaker.before_call()
+            try:
+                if stop_after_sql_block:
+                    response = self._stream_until_sql_block(prompt, generation_config)
+                else:
+                    response = self.model.generate_content(
+                        prompt,
+                        generation_config=generation_config,
+                        safety_settings=SAFETY_FILTER_CONFIG,
+                    ).text
+            except Exception as e:
+                breaker.record_failure(e)
+                raise
+            breaker.record_success()
+            return response
+
+        # The raw response is cached, so the parser still runs on cache hits.
+        response = llm_cache.cached_call(
+            self.model_name,
+            {
+                "temperature": self.temperature,
                 **self.arguments,
-            ),
-            safety_settings=SAFETY_FILTER_CONFIG,
-        ).text
+                "cache_name": self.cache_name,
+                "stop_after_sql_block": stop_after_sql_block,
+            },
+            prompt,
+            generate,
+            deterministic=self.temperature == 0 if cache is None else cache,
+        )
         if parser_func:
             return parser_func(response)
         return response
@@ -177,56 +460,89 @@ class GeminiModel:
         parser_func: Optional[Callable[[str], str]] = None,
         timeout: int = 60,
         max_retries: int = 5,
+        stop_after_sql_block: bool = False,
+        stage: str = "generation",
+        cache: bool | None = None,
     ) -> List[Optional[str]]:
         """Calls the Gemini model for multiple prompts in parallel using threads with retry logic.
 
         Args:
             prompts (List[str]): A list of prompts to call the model with.
             parser_func (callable, optional): A function to process each response.
-            timeout (int): The maximum time (in seconds) to wait for each thread.
-            max_retries (int): The maximum number of retries for timed-out threads.
+            timeout (int): The maximum time (in seconds) to wait for the calls.
+              call_parallel returns by then with the finished results; calls
+              still running are abandoned and reported as TIMEOUT_RESPONSE.
+            max_retries (int): The maximum number of retries of a prompt whose
+              call still failed with a transient error after `call`'s own retries.
+            stop_after_sql_block (bool): Stop each generation once its ```sql
+              block is complete. See `call`.
+            stage (str): The pipeline stage the calls belong to; `timeout` is
+              capped at its share of the question deadline.
+            cache (bool, optional): Passed to `call` for every prompt.
 
         Returns:
             List[Optional[str]]:
-            A list of responses, or None for threads that failed.
+            A list of responses in prompt order; failed calls hold an error
+            string and unfinished ones TIMEOUT_RESPONSE.
         """
         results = [None] * len(prompts)
+        timeout = deadline.stage_timeout(stage, timeout)
+        abandoned = threading.Event()
 
         def worker(index: int, prompt: str):
             """Thread worker function to call the model and store the result with retries."""
             retries = 0
             while retries <= max_retries:
                 try:
-                    return self.call(prompt, parser_func)
+                    return self.call(
+                        prompt,
+                        parser_func,
+                        stop_after_sql_block=stop_after_sql_block,
+                        cache=cache,
+                    )
                 except Exception as e:  # pylint: disable=broad-exception-caught
-                    print(f"Error for prompt {index}: {str(e)}")
+                    logger.warning("Error for prompt %d: %s", index, e)
+                    if not is_retryable(e):
+                        return f"Error: {str(e)}"
                     retries += 1
-                    if retries <= max_retries:
-                        print(f"Retrying ({retries}/{max_retries}) for prompt {index}")
-                        time.sleep(1)  # Small delay before retrying
+                    if retries <= max_retries and not deadline.expired() and not abandoned.is_set():
+                        logger.info("Retrying (%d/%d) for prompt %d", retries, max_retries, index)
+                        RETRY_STATS["retries"] += 1
+                        time.sleep(retry_after(e) or 1)  # Small delay before retrying
                     else:
                         return f"Error after retries: {str(e)}"
 
-        # Create and start one thread for each prompt
-        with ThreadPoolExecutor(max_workers=len(prompts)) as executor:
+        # Create and start one thread for each prompt. The executor is not used as
+        # a context manager: leaving the `with` block would wait for every straggler.
+        executor = ThreadPoolExecutor(max_workers=len(prompts))
+        try:
             future_to_index = {
-                executor.submit(worker, i, prompt): i
+                # Copy the context so the workers see the question deadline.
+                executor.submit(contextvars.copy_context().run, worker, i, prompt): i
                 for i, prompt in enumerate(prompts)
             }
 
-            for future in as_completed(future_to_index, timeout=timeout):
-                index = future_to_index[future]
-                try:
-                    results[index] = future.result()
-                except Exception as e:  # pylint: disable=broad-exception-caught
-                    print(f"Unhandled error for prompt {index}: {e}")
-                    results[index] = "Unhandled Error"
+            try:
+                for future in as_completed(future_to_index, timeout=timeout):
+                    index = future_to_index[future]
+                    try:
+                        results[index] = future.result()
+                    except Exception as e:  # pylint: disable=broad-exception-caught
+                        logger.error("Unhandled error for prompt %d: %s", index, e)
+                        results[index] = "Unhandled Error"
+            except TimeoutError:
+                pass
+        finally:
+            # Unfinished calls keep running in their threads until the model
+            # answers, but stop retrying; their results are discarded.
+            abandoned.set()
+            executor.shutdown(wait=False, cancel_futures=True)
 
         # Handle remaining unfinished tasks after the timeout
         for future in future_to_index:
             index = future_to_index[future]
             if not future.done():
-                print(f"Timeout occurred for prompt {index}")
-                results[index] = "Timeout"
+                logger.warning("Timeout occurred for prompt %d", index)
+                results[index] = TIMEOUT_RESPONSE
 
         return results
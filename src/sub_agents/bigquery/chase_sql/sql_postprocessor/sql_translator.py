@@ -14,6 +14,9 @@
 
 """Translator from SQLite to BigQuery."""
 
+import collections
+import difflib
+import logging
 import re
 from typing import Any, Final
 
@@ -21,7 +24,7 @@ import regex
 import sqlglot
 import sqlglot.optimizer
 
-from ..llm_utils import GeminiModel  # pylint: disable=g-importing-member
+from ..llm_utils import TIMEOUT_RESPONSE, GeminiModel  # pylint: disable=g-importing-member
 from .correction_prompt_template import (
     CORRECTION_PROMPT_TEMPLATE_V1_0,
 )  # pylint: disable=g-importing-member
@@ -37,6 +40,18 @@ SQLGlotSchemaType = dict[str, Any]
 
 BirdSampleType = dict[str, Any]
 
+logger = logging.getLogger(__name__)
+
+# Process-wide counters for the error correction rounds. A round fixed by the
+# local repair rules counts as `llm_corrections_avoided`; a round that still
+# needed the LLM counts as `llm_corrections`.
+REPAIR_STATS: collections.Counter[str] = collections.Counter()
+
+
+def get_repair_stats() -> dict[str, int]:
+    """Returns a snapshot of the error correction counters."""
+    return dict(REPAIR_STATS)
+
 
 def _isinstance_list_of_str_tuples_lists(obj: Any) -> bool:
     """Checks if the object is a list of tuples or listsof strings."""
@@ -156,6 +171,14 @@ class SqlTranslator:
     @classmethod
     def _extract_schema_from_ddl_statement(cls, ddl_statement: str) -> TableSchemaType:
         """Extracts the schema from a single DDL statement."""
+        # Drop the table options after the column list (PARTITION BY, CLUSTER BY,
+        # OPTIONS(...)) so that the last parenthesis closes the columns.
+        ddl_statement = regex.sub(
+            r"\)\s*\n\s*(?:PARTITION\s+BY|CLUSTER\s+BY|OPTIONS\s*\().*;\s*$",
+            ");",
+            ddl_statement,
+            flags=re.DOTALL,
+        )
         # Split the DDL statement into table name and columns.
         # Match the following pattern:
         # CREATE [OR REPLACE] TABLE [`]<table_name>[`] (<all_columns>);
@@ -345,6 +368,198 @@ class SqlTranslator:
             return str(e), sql_query
         return None, sql_query
 
+    @classmethod
+    def _flatten_schema(
+        cls, schema_dict: SQLGlotSchemaType | None
+    ) -> tuple[dict[str, str], set[str]]:
+        """Returns the table names keyed by their lower case form, and the lower
+        case column names found in a (possibly nested) SQLGlot schema."""
+        tables: dict[str, str] = {}
+        columns: set[str] = set()
+
+        def visit(node: dict[str, Any]) -> None:
+            for key, value in node.items():
+                if not isinstance(value, dict):
+                    continue
+                if value and all(isinstance(v, str) for v in value.values()):
+                    tables[key.lower()] = key
+                    columns.update(c.lower() for c in value)
+                else:
+                    visit(value)
+
+        if schema_dict:
+            visit(schema_dict)
+        return tables, columns
+
+    @classmethod
+    def _repair_table_names(
+        cls, sql_query_ast: sqlglot.exp.Expression, tables: dict[str, str]
+    ) -> bool:
+        """Rewrites table names to the casing used in the schema.
+
+        BigQuery table names are case sensitive, so `imconstraint` does not
+        resolve to `imConstraint`. Returns True if any table name was changed.
+        """
+        cte_names = {cte.alias_or_name for cte in sql_query_ast.find_all(sqlglot.exp.CTE)}
+        changed = False
+        for table in sql_query_ast.find_all(sqlglot.exp.Table):
+            if table.name in cte_names:
+                continue
+            schema_name = tables.get(table.name.lower())
+            if schema_name and schema_name != table.name:
+                table.set("this", sqlglot.exp.Identifier(this=schema_name, quoted=True))
+                changed = True
+        return changed
+
+    @staticmethod
+    def _near_column(token: str, columns: set[str]) -> bool:
+        """True if the token is a column name or a likely misspelling of one."""
+        return bool(difflib.get_close_matches(token.lower(), columns, n=1, cutoff=0.8))
+
+    @staticmethod
+    def _expects_literal(column: sqlglot.exp.Column) -> bool:
+        """True where a double-quoted token can only sensibly be a string.
+
+        That is the right-hand side of a comparison or LIKE, an IN list, BETWEEN
+        bounds, a date format argument or a token containing a `%` pattern.
+        """
+        parent, arg_key = column.parent, column.arg_key
+        if "%" in column.name or arg_key == "format":
+            return True
+        if isinstance(parent, (sqlglot.exp.EQ, sqlglot.exp.NEQ, sqlglot.exp.GT,
+                               sqlglot.exp.GTE, sqlglot.exp.LT, sqlglot.exp.LTE,
+                               sqlglot.exp.Like, sqlglot.exp.ILike)):
+            return arg_key == "expression"
+        if isinstance(parent, sqlglot.exp.In):
+            return arg_key == "expressions"
+        if isinstance(parent, sqlglot.exp.Between):
+            return arg_key in ("low", "high")
+        return False
+
+    @classmethod
+    def _has_misspelled_column(
+        cls, sql_query: str, double_quoted: set[str], columns: set[str]
+    ) -> bool:
+        """True if a double-quoted token outside a literal position is close to,
+        but not, a schema column, e.g. "constraint_nme"."""
+        try:
+            sql_query_ast = sqlglot.parse_one(
+                sql=sql_query,
+                read=cls.INPUT_DIALECT,
+                error_level=sqlglot.ErrorLevel.IMMEDIATE,
+            )
+        except sqlglot.errors.SqlglotError:
+            return False
+        for column in sql_query_ast.find_all(sqlglot.exp.Column):
+            name = column.name
+            if (
+                name in double_quoted
+                and name.lower() not in columns
+                and not cls._expects_literal(column)
+                and cls._near_column(name, columns)
+            ):
+                return True
+        return False
+
+    @classmethod
+    def _repair_quoted_literals(
+        cls,
+        sql_query_ast: sqlglot.exp.Expression,
+        double_quoted: set[str],
+        columns: set[str],
+    ) -> bool:
+        """Turns double-quoted identifiers that are not columns back into strings.
+
+        When the query is read with the input dialect every double-quoted token
+        becomes an identifier, including string literals like "MISO" or "%Y".
+        Only tokens that are neither schema columns nor aliases, and that sit
+        where a literal is expected, are rewritten. Returns True if any
+        identifier was changed.
+        """
+        aliases = {
+            alias.alias.lower() for alias in sql_query_ast.find_all(sqlglot.exp.Alias)
+        }
+        changed = False
+        for column in list(sql_query_ast.find_all(sqlglot.exp.Column)):
+            identifier = column.this
+            if (
+                not column.table
+                and isinstance(identifier, sqlglot.exp.Identifier)
+                and identifier.quoted
+                and identifier.name in double_quoted
+                and identifier.name.lower() not in columns
+                and identifier.name.lower() not in aliases
+                and cls._expects_literal(column)
+            ):
+                column.replace(sqlglot.exp.Literal.string(identifier.name))
+                changed = True
+        return changed
+
+    @classmethod
+    def _repair_locally(
+        cls,
+        sql_query: str,
+        db: str | None = None,
+        catalog: str | None = None,
+        schema_dict: SQLGlotSchemaType | None = None,
+    ) -> str | None:
+        """Applies deterministic repair rules to the SQL query.
+
+        The rules operate on the SQLGlot AST and cover the mechanical errors that
+        would otherwise need an LLM correction round trip:
+        1. Table names with the wrong casing are mapped back to the schema names.
+        2. Double-quoted identifiers and SQLite-only functions are handled by
+           reading the query with the input dialect and writing BigQuery.
+        3. Double-quoted string literals are restored as strings.
+        4. Missing project and dataset prefixes are added by the error check.
+        Queries with a double-quoted token that looks like a misspelled column
+        are left to the LLM: either dialect would read it as a constant string.
+
+        Args:
+          sql_query: The SQL query to repair.
+          db: The database to use for the repair. This field is optional.
+          catalog: The catalog to use for the repair. This field is optional.
+          schema_dict: The DDL schema in the SQLGlot format. This field is
+            optional.
+
+        Returns:
+          The repaired SQL query if it passes the error check, otherwise None.
+        """
+        tables, columns = cls._flatten_schema(schema_dict)
+        double_quoted = set(re.findall(r'"([^"]+)"', sql_query))
+        if cls._has_misspelled_column(sql_query, double_quoted, columns):
+            return None
+        read_dialects = [cls.OUTPUT_DIALECT, cls.INPUT_DIALECT]
+        if any(token.lower() in columns for token in double_quoted):
+            # Reading double-quoted column names as BigQuery strings would
+            # silently turn them into constants, so try the input dialect first.
+            read_dialects.reverse()
+        for read_dialect in read_dialects:
+            try:
+                sql_query_ast = sqlglot.parse_one(
+                    sql=sql_query,
+                    read=read_dialect,
+                    error_level=sqlglot.ErrorLevel.IMMEDIATE,
+                )
+            except sqlglot.errors.SqlglotError:
+                continue
+            changed = cls._repair_table_names(sql_query_ast, tables)
+            if read_dialect == cls.INPUT_DIALECT:
+                cls._repair_quoted_literals(sql_query_ast, double_quoted, columns)
+            elif not changed:
+                # Nothing to repair; the check would fail exactly as before.
+                continue
+            errors, repaired_query = cls._check_for_errors(
+                sql_query=sql_query_ast.sql(cls.OUTPUT_DIALECT),
+                sql_dialect=cls.OUTPUT_DIALECT,
+                db=db,
+                catalog=catalog,
+                schema_dict=schema_dict,
+            )
+            if not errors:
+                return repaired_query
+        return None
+
     def _fix_errors(
         self,
         sql_query: str,
@@ -387,7 +602,15 @@ class SqlTranslator:
         errors, sql_query = errors_and_sql
         responses = sql_query  # Default to the input SQL query after error check.
         if errors:
-            print("Processing input errors")
+            # Try the deterministic repair rules before paying for an LLM call.
+            repaired_query = self._repair_locally(
+                sql_query, db=db, catalog=catalog, schema_dict=schema_dict
+            )
+            if repaired_query is not None:
+                REPAIR_STATS["llm_corrections_avoided"] += 1
+                return repaired_query
+            REPAIR_STATS["llm_corrections"] += 1
+            logger.info("Processing input errors")
             if schema_dict:
                 # If the schema is provided, then insert it into the prompt.
                 schema_insert = f"\nThe database schema is:\n{schema_dict}\n"
@@ -400,19 +623,25 @@ class SqlTranslator:
                 schema_insert=schema_insert,
             )
             requests: list[str] = [prompt for _ in range(number_of_candidates)]
-            responses: list[str] = self._model.call_parallel(
-                requests, parser_func=self._parse_response
-            )
+            try:
+                responses: list[str] = self._model.call_parallel(
+                    requests, parser_func=self._parse_response, stage="correction"
+                )
+            except TimeoutError as e:
+                # Out of time for the correction: keep the uncorrected query.
+                logger.warning("Skipping LLM correction: %s", e)
+                return sql_query
             if responses:
                 # We only use the first response. Therefore the `number_of_candidates`
                 # parameter is not used.
                 # pylint: disable=g-bad-todo
                 # pylint: enable=g-bad-todo
-                # First, find the first non-None response.
-                responses = [r for r in responses if r is not None]
-                if responses:
-                    # Then, return the first non-None response.
-                    responses = responses[0]
+                # First, find the first response that finished in time.
+                responses = [
+                    r for r in responses if r is not None and r != TIMEOUT_RESPONSE
+                ]
+                # Then, return it, or the uncorrected query if there is none.
+                responses = responses[0] if responses else sql_query
         return responses
 
     def translate(
@@ -435,7 +664,7 @@ class SqlTranslator:
         Returns:
           The translated SQL query.
         """
-        print("****** sql_query at translator entry:", sql_query)
+        logger.debug("sql_query at translator entry: %s", sql_query)
         if self._process_input_errors:
             sql_query = self._fix_errors(
                 sql_query,
@@ -445,7 +674,7 @@ class SqlTranslator:
                 ddl_schema=ddl_schema,
                 apply_heuristics=True,
             )
-        print("****** sql_query after fix_errors:", sql_query)
+        logger.debug("sql_query after fix_errors: %s", sql_query)
         sql_query = sqlglot.transpile(
             sql=sql_query,
             read=self.INPUT_DIALECT,
@@ -454,7 +683,7 @@ class SqlTranslator:
         )[
             0
         ]  # Transpile returns a list of strings.
-        print("****** sql_query after transpile:", sql_query)
+        logger.debug("sql_query after transpile: %s", sql_query)
         if self._tool_output_errors:
             sql_query = self._fix_errors(
                 sql_query,
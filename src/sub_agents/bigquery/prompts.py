@@ -20,6 +20,7 @@ def return_instructions_bigquery() -> str:
 *   **Schema Adherence:** Only use the tables and columns provided in the schema. Do not invent or assume the existence of any other tables or columns.
 *   **Clarity and Simplicity:** Write clear and understandable SQL. Use aliases where necessary to improve readability.
 *   **Efficiency:** Construct queries that are as efficient as possible. Avoid unnecessary joins or complex subqueries if a simpler approach exists.
+*   **Bytes Scanned:** Filter on the `PARTITION BY` and `CLUSTER BY` columns shown in the schema whenever possible, and prefer the smallest table (see the row counts and sizes in the schema) that answers the question.
 *   **Final Answer:** After the query is executed and the results are formatted, present the information to the user in a clear and concise way. If there are no results, inform the user of that.
 *   **LIMIT Clause:** Always include a `LIMIT {limit}` clause to prevent excessively large result sets."""
     else: # Default to BASELINE instructions
@@ -28,5 +29,6 @@ def return_instructions_bigquery() -> str:
 * Generate a **BigQuery SELECT** query using only visible tables/columns.
 * Never `SELECT *`; only needed columns.
 * Always include a time filter if present in the question or default to last 30 days.
+* Filter on the `PARTITION BY` and `CLUSTER BY` columns shown in the schema whenever possible, and prefer the smallest table that answers the question.
 * Always include `LIMIT {limit}`.
 * After the query is executed and the results are formatted, present the information to the user in a clear and concise way. If there are no results, inform the user of that."""
\ No newline at end of file
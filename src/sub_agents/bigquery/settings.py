@@ -0,0 +1,122 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from tools import deadline
+from tools.schema import SCHEMA_CACHE_TTL_SECONDS, get_cached_bigquery_schema, list_bigquery_datasets
+
+# Session state key holding the DDL of every schema handle handed to the agent.
+SCHEMA_HANDLES_KEY = "schema_handles"
+# Session state key holding the complexity signature of the question whose SQL
+# awaits execution, so its outcome can be added to the failure history.
+COMPLEXITY_SIGNATURE_KEY = "complexity_signature"
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="warm_start")
+_prefetch_lock = threading.Lock()
+_prefetch = None  # (monotonic start time, Future of get_database_settings())
+
+def _env_flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).lower() in ("true", "1", "t")
+
+def default_dataset_ids() -> list[str]:
+    """Returns BQ_DATASET_ID if set, otherwise every dataset in BQ_DATA_PROJECT_ID."""
+    specific_dataset_id = os.getenv("BQ_DATASET_ID")
+    if specific_dataset_id:
+        return [specific_dataset_id]
+    return list_bigquery_datasets(os.getenv("BQ_DATA_PROJECT_ID"))
+
+def schema_handle_for(dataset_ids: list[str]) -> str:
+    return f"schema:{','.join(dataset_ids)}"
+
+def load_schema(dataset_ids: list[str]) -> str:
+    """Returns the (cached) DDL for the datasets, honoring BQ_TABLE_ALLOWLIST."""
+    table_allowlist_str = os.getenv("BQ_TABLE_ALLOWLIST")
+    table_allowlist = [table.strip() for table in table_allowlist_str.split(',')] if table_allowlist_str else None
+    return get_cached_bigquery_schema(
+        dataset_ids=dataset_ids,
+        data_project_id=os.getenv("BQ_DATA_PROJECT_ID"),
+        compute_project_id=os.getenv("BQ_COMPUTE_PROJECT_ID"),
+        table_allowlist=table_allowlist,
+    )
+
+def get_database_settings() -> dict:
+    """Builds the database_settings read by the NL2SQL tools: DDL, project, dataset and CHASE options."""
+    dataset_ids = default_dataset_ids()
+    return {
+        "bq_ddl_schema": load_schema(dataset_ids),
+        "bq_schema_handle": schema_handle_for(dataset_ids),
+        "bq_data_project_id": os.getenv("BQ_DATA_PROJECT_ID"),
+        "bq_dataset_id": dataset_ids[0] if dataset_ids else None,
+        "transpile_to_bigquery": _env_flag("CHASE_TRANSPILE_TO_BIGQUERY", "True"),
+        "process_input_errors": _env_flag("CHASE_PROCESS_INPUT_ERRORS", "True"),
+        "process_tool_output_errors": _env_flag("CHASE_PROCESS_TOOL_OUTPUT_ERRORS", "True"),
+        "number_of_candidates": int(os.getenv("CHASE_NUMBER_OF_CANDIDATES", "1")),
+        "adaptive_candidates": _env_flag("CHASE_ADAPTIVE_CANDIDATES", "False"),
+        "max_candidates": int(os.getenv("CHASE_MAX_CANDIDATES", "3")),
+        "model": os.getenv("CHASE_MODEL", "gemini-2.5-flash"),
+        "cascade_model": os.getenv("CHASE_CASCADE_MODEL"),
+        "temperature": float(os.getenv("CHASE_TEMPERATURE", "0.5")),
+        "generate_sql_type": os.getenv("CHASE_GENERATE_SQL_TYPE", "dc"),
+        "stop_after_sql_block": _env_flag("CHASE_STOP_AFTER_SQL_BLOCK", "True"),
+    }
+
+def prefetch_database_settings():
+    """Starts get_database_settings() in a background thread and returns its Future.
+
+    The Future is shared by all sessions in the process and renewed once it fails
+    or is older than the schema cache TTL.
+    """
+    global _prefetch
+    with _prefetch_lock:
+        if _prefetch is not None:
+            started, future = _prefetch
+            expired = time.monotonic() - started > SCHEMA_CACHE_TTL_SECONDS
+            failed = future.done() and future.exception() is not None
+            if not expired and not failed:
+                return future
+        future = _executor.submit(get_database_settings)
+        _prefetch = (time.monotonic(), future)
+        return future
+
+def _has_database_settings(state) -> bool:
+    settings = state.get("database_settings") or {}
+    return "model" in settings and bool(settings.get("bq_ddl_schema"))
+
+def _store_database_settings(state, prefetched: dict) -> dict:
+    # Values written by tools during the session (e.g. another dataset's schema)
+    # take precedence over the prefetched defaults.
+    database_settings = {**prefetched, **(state.get("database_settings") or {})}
+    state["database_settings"] = database_settings
+
+    schema_handles = dict(state.get(SCHEMA_HANDLES_KEY) or {})
+    schema_handles.setdefault(prefetched["bq_schema_handle"], prefetched["bq_ddl_schema"])
+    state[SCHEMA_HANDLES_KEY] = schema_handles
+    return database_settings
+
+def start_warm_start(state) -> None:
+    """Kicks off the settings prefetch without blocking; stores them right away if already loaded."""
+    if _has_database_settings(state):
+        return
+    future = prefetch_database_settings()
+    if future.done() and future.exception() is None:
+        _store_database_settings(state, future.result())
+
+def ensure_database_settings(state) -> dict:
+    """Returns database_settings from state, waiting for the prefetch if it is still running.
+
+    The wait is bounded by the schema share of the question deadline; DeadlineExceeded
+    is raised when it runs out.
+    """
+    if _has_database_settings(state):
+        return state["database_settings"]
+    timeout = deadline.stage_timeout("schema")
+    future = prefetch_database_settings()
+    try:
+        prefetched = future.result(timeout=timeout)
+    except FutureTimeoutError:
+        # Only the wait running out is a deadline overrun; a timeout raised by the
+        # prefetch itself (e.g. socket.timeout from the BigQuery client) propagates.
+        if timeout is None or future.done():
+            raise
+        raise deadline.DeadlineExceeded("schema", deadline.current().seconds) from None
+    return _store_database_settings(state, prefetched)
@@ -1,10 +1,26 @@
 from google.adk.tools import ToolContext
+import asyncio
 import google.generativeai as genai
+import logging
+import math
 import os
-from tools.bigquery_io import execute_query
-from tools.answers import format_results
-from tools.schema import get_bigquery_schema, list_bigquery_datasets
-from tools.validator import enforce
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from tools.bigquery_io import billed_bytes, execute_query, execute_query_async, job_stats
+from tools.answers import format_bytes, format_results, format_results_compact
+from tools.nl2sql import generate_sql, repair_sql
+from tools import cascade
+from tools import complexity
+from tools import cost_policy
+from tools import deadline
+from tools import result_store as results_lib
+from tools import rewriter
+from tools import window_cache
+from tools.schema import get_table_metadata, get_table_partitioning, list_bigquery_datasets, prune_ddl
+from tools.validator import dry_run, enforce
+from .settings import COMPLEXITY_SIGNATURE_KEY, SCHEMA_HANDLES_KEY, ensure_database_settings, load_schema, schema_handle_for
 
 # Configure the client with the API key from environment variables
 api_key = os.getenv("GOOGLE_API_KEY")
@@ -20,74 +36,589 @@ if not model_name:
 # Initialize the generative model to be used by the tools
 llm_model = genai.GenerativeModel(model_name)
 
-def get_schema_for_datasets(dataset_ids: str) -> str:
-    """Retrieves the DDL schema for a comma-separated list of BigQuery dataset IDs."""
+# Optional cheaper model tried first; its query is checked against the schema and
+# dry-run, and the question escalates to BASELINE_NL2SQL_MODEL if that fails.
+cascade_model_name = os.getenv("BASELINE_NL2SQL_CASCADE_MODEL")
+cascade_llm_model = genai.GenerativeModel(cascade_model_name) if cascade_model_name else None
+
+logger = logging.getLogger(__name__)
+
+# Answer time-ranged per-day queries from cached day buckets, querying only missing days.
+WINDOW_CACHE = os.getenv("WINDOW_CACHE", "False").lower() in ("true", "1", "t")
+
+# "compact" (default) or "table" for the original human-readable formatter.
+RESULT_FORMAT = os.getenv("RESULT_FORMAT", "compact").lower()
+RESULT_FLOAT_PRECISION = int(os.getenv("RESULT_FLOAT_PRECISION", "4"))
+RESULT_STATS_THRESHOLD = int(os.getenv("RESULT_STATS_THRESHOLD", "50"))
+
+# Query results are kept locally under handles so follow-ups don't go back to BigQuery.
+RESULT_PREVIEW_ROWS = int(os.getenv("RESULT_PREVIEW_ROWS", "200"))
+result_store = results_lib.ResultStore(
+    memory_budget_bytes=int(os.getenv("RESULT_STORE_MEMORY_MB", "512")) * 2**20
+)
+
+# Opt-in repair loop inside validate_and_execute_query. 0 attempts disables it.
+REPAIR_MAX_ATTEMPTS = int(os.getenv("BQ_REPAIR_MAX_ATTEMPTS", "0"))
+REPAIR_MAX_SECONDS = float(os.getenv("BQ_REPAIR_MAX_SECONDS", "60"))
+
+# Rewrite queries before execution: cap LIMIT at BQ_DEFAULT_LIMIT and add a
+# BQ_DEFAULT_DAYS filter on partitioned tables read without a partition filter.
+ENFORCE_QUERY_LIMITS = os.getenv("BQ_ENFORCE_QUERY_LIMITS", "True").lower() in ("true", "1", "t")
+DEFAULT_DAYS = int(os.getenv("BQ_DEFAULT_DAYS", "30"))
+
+# Expand SELECT * and drop columns unused downstream when the dry run shows it saves bytes.
+PRUNE_COLUMNS = os.getenv("BQ_PRUNE_COLUMNS", "True").lower() in ("true", "1", "t")
+WIDE_PROJECTION_COLUMNS = int(os.getenv("BQ_WIDE_PROJECTION_COLUMNS", "20"))
+PRUNING_STATS = Counter()
+
+# BigQuery jobs still running after this many seconds, or once the execution share of
+# the question deadline (QUESTION_DEADLINE_SECONDS) is used up, are cancelled.
+QUERY_TIMEOUT_SECONDS = float(os.getenv("BQ_QUERY_TIMEOUT_SECONDS", "300"))
+
+# Queries estimated to scan at most BQ_SHORT_QUERY_MAX_BYTES run in job-optional mode,
+# which skips the job insert/poll/fetch round trips; BigQuery creates a job on its own
+# if the query turns out to be long.
+SHORT_QUERY_MODE = os.getenv("BQ_SHORT_QUERY_MODE", "True").lower() in ("true", "1", "t")
+SHORT_QUERY_MAX_BYTES = int(os.getenv("BQ_SHORT_QUERY_MAX_BYTES", str(2**30)))
+
+# Progressive execution: queries estimated to scan at least BQ_PROGRESSIVE_MIN_BYTES
+# are answered from a TABLESAMPLE first while the exact query runs in the background.
+PROGRESSIVE_MIN_BYTES = int(os.getenv("BQ_PROGRESSIVE_MIN_BYTES", "0"))
+PROGRESSIVE_SAMPLE_PERCENT = float(os.getenv("BQ_PROGRESSIVE_SAMPLE_PERCENT", "5"))
+_progressive_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="exact_query")
+_progressive = {}  # result handle -> (monotonic start, Future of the exact table)
+_progressive_lock = threading.Lock()
+
+# Lets the agent ask for APPROX_COUNT_DISTINCT / APPROX_QUANTILES / APPROX_TOP_COUNT
+# instead of exact aggregates on exploratory questions.
+APPROXIMATE_AGGREGATES = os.getenv("BQ_APPROXIMATE_AGGREGATES", "False").lower() in ("true", "1", "t")
+
+def get_schema_for_datasets(dataset_ids: str, tool_context: ToolContext) -> str:
+    """Retrieves the DDL schema for a comma-separated list of BigQuery dataset IDs.
+
+    The DDL is stored in session state under a schema handle, which is returned
+    together with the DDL. Pass the handle, not the DDL, to `initial_bq_nl2sql`.
+    """
     dataset_id_list = [dataset.strip() for dataset in dataset_ids.split(',')]
-    data_project_id = os.getenv("BQ_DATA_PROJECT_ID")
-    compute_project_id = os.getenv("BQ_COMPUTE_PROJECT_ID")
-    table_allowlist_str = os.getenv("BQ_TABLE_ALLOWLIST")
-    table_allowlist = [table.strip() for table in table_allowlist_str.split(',')] if table_allowlist_str else None
-
-    return get_bigquery_schema(
-        dataset_ids=dataset_id_list,
-        data_project_id=data_project_id,
-        compute_project_id=compute_project_id,
-        table_allowlist=table_allowlist
+    ddl_schema = load_schema(dataset_id_list)
+
+    handle = schema_handle_for(dataset_id_list)
+    # Reassign the dicts instead of mutating them so the state delta is recorded.
+    schema_handles = dict(tool_context.state.get(SCHEMA_HANDLES_KEY) or {})
+    schema_handles[handle] = ddl_schema
+    tool_context.state[SCHEMA_HANDLES_KEY] = schema_handles
+
+    # Mirror the latest schema into the settings the CHASE tools read.
+    database_settings = dict(tool_context.state.get("database_settings") or {})
+    database_settings["bq_ddl_schema"] = ddl_schema
+    database_settings["bq_data_project_id"] = os.getenv("BQ_DATA_PROJECT_ID")
+    database_settings["bq_dataset_id"] = dataset_id_list[0]
+    tool_context.state["database_settings"] = database_settings
+
+    return (
+        f"Schema handle: {handle}\n"
+        f"Pass this handle as `schema_handle` to `initial_bq_nl2sql`; do not copy the DDL.\n\n"
+        f"{ddl_schema}"
     )
 
-def initial_bq_nl2sql(question: str, schema: str) -> str:
-    """Generates an initial SQL query from a natural language question and a given schema."""
+def resolve_schema_handle(schema_handle: str, tool_context: ToolContext) -> str | None:
+    """Returns the DDL stored under a schema handle.
+
+    Falls back to the session's `database_settings` schema (prefetched by the
+    warm-start callback), and accepts raw DDL text for callers that still pass
+    the schema itself.
+    """
+    schema_handles = tool_context.state.get(SCHEMA_HANDLES_KEY) or {}
+    if schema_handle in schema_handles:
+        return schema_handles[schema_handle]
+    if "CREATE" in schema_handle.upper():
+        return schema_handle
+    return ensure_database_settings(tool_context.state).get("bq_ddl_schema")
 
-    prompt_template = """You are a BigQuery SQL expert.
-Given a question and a database schema, your task is to generate a SQL query that answers the question.
+def _generate_sql(question: str, schema: str, max_rows: str) -> str:
+    """Generates SQL with BASELINE_NL2SQL_MODEL, or through the model cascade if one is configured."""
+    def generate(model):
+        return lambda usage: generate_sql(
+            model, question, schema, max_rows, timeout=deadline.stage_timeout("generation"), usage=usage
+        )
 
-###
-DATABASE SCHEMA:
-{SCHEMA}
-###
+    if cascade_llm_model is None:
+        return generate(llm_model)(None)
+    return cascade.generate(
+        (cascade_model_name, generate(cascade_llm_model)),
+        (model_name, generate(llm_model)),
+        lambda sql: cascade.escalation_reason(sql, schema),
+    )
 
-QUESTION:
-{QUESTION}
+def initial_bq_nl2sql(question: str, schema_handle: str, tool_context: ToolContext) -> str:
+    """Generates an initial SQL query from a natural language question.
 
-###
-INSTRUCTIONS:
-- The SQL query should be written for BigQuery.
-- The query should be correct and executable.
-- The query should be as simple as possible.
-- The query should return a maximum of {MAX_NUM_ROWS} rows.
-- Do not add any comments to the query.
-- Do not add any text before or after the query.
-- The query should be written in a single line.
-"""
+    `schema_handle` is the handle returned by `get_schema_for_datasets`.
+    """
+    try:
+        schema = resolve_schema_handle(schema_handle, tool_context)
+        if not schema:
+            return f"Error: unknown schema handle '{schema_handle}'. Call get_schema_for_datasets first."
+        MAX_NUM_ROWS = os.getenv('BQ_DEFAULT_LIMIT', '200')
+        return _generate_sql(question, schema, MAX_NUM_ROWS)
+    except deadline.DeadlineExceeded as e:
+        return _deadline_error(e)
 
-    MAX_NUM_ROWS = os.getenv('BQ_DEFAULT_LIMIT', '200')
+def _format_rows(rows) -> str:
+    """Formats a list of result rows with the configured RESULT_FORMAT."""
+    if RESULT_FORMAT == "compact":
+        return format_results_compact(
+            rows, precision=RESULT_FLOAT_PRECISION, stats_threshold=RESULT_STATS_THRESHOLD
+        )
+    return format_results(rows)
 
-    prompt = prompt_template.format(
-        MAX_NUM_ROWS=MAX_NUM_ROWS, SCHEMA=schema, QUESTION=question
+def _stat(value, spec: str = "") -> str:
+    return "n/a" if value is None else format(value, spec)
+
+def _present_result(handle: str, table) -> str:
+    """Formats a stored result: its handle and size, a preview, and full-table stats if truncated."""
+    header = f"Result handle: {handle} ({table.num_rows} rows)."
+    if table.num_rows <= RESULT_PREVIEW_ROWS:
+        return f"{header}\n{_format_rows(table.to_pylist())}"
+
+    header += (
+        f" Showing the first {RESULT_PREVIEW_ROWS}; use page_result, filter_result, "
+        "sort_result or aggregate_result on the handle for the rest."
     )
+    # min, max and mean are None for an all-null column (e.g. the far side of a LEFT JOIN).
+    stats = "\n".join(
+        f"  {column}: {count}, {_stat(minimum)}, {_stat(maximum)}, {_stat(mean, '.4f')}"
+        for column, (count, minimum, maximum, mean) in results_lib.numeric_stats(table).items()
+    )
+    preview = _format_rows(table.slice(0, RESULT_PREVIEW_ROWS).to_pylist())
+    if stats:
+        preview += f"\nstats over all rows (count, min, max, mean):\n{stats}"
+    return f"{header}\n{preview}"
+
+def _column_types(table_id: str) -> dict | None:
+    """Returns {column: BigQuery type} of a table from its (cached) metadata, for the window cache."""
+    metadata = get_table_metadata([table_id], compute_project_id=os.getenv("BQ_COMPUTE_PROJECT_ID"))
+    return metadata[table_id]["columns"] if table_id in metadata else None
 
-    response = llm_model.generate_content(
-        contents=prompt,
+def _execute(sql_string: str, maximum_bytes_billed: int | None = None, jobs: list | None = None,
+             use_window_cache: bool = True):
+    """Executes the query, going through the time-window cache when it applies."""
+    if WINDOW_CACHE and use_window_cache:
+        try:
+            rows, stats = window_cache.execute(
+                sql_string,
+                lambda sql: [dict(row.items()) for row in execute_query(sql, maximum_bytes_billed, jobs)],
+                _column_types,
+            )
+            logger.info("Window cache: %s", stats)
+            return rows
+        except window_cache.NotDecomposable as e:
+            logger.info("Window cache skipped: %s", e)
+    return execute_query(sql_string, maximum_bytes_billed, jobs)
+
+async def _execute_async(sql_string: str, maximum_bytes_billed: int | None = None, jobs: list | None = None,
+                         use_window_cache: bool = True, short_query: bool = False):
+    """Like _execute, but awaits the BigQuery job and cancels it after QUERY_TIMEOUT_SECONDS
+    or the execution share of the question deadline, whichever comes first.
+
+    `short_query` runs the query in job-optional mode.
+    """
+    if WINDOW_CACHE and use_window_cache:
+        try:
+            # Reads table metadata on a cold cache, so off the event loop.
+            await asyncio.to_thread(window_cache.analyze, sql_string, _column_types)
+        except window_cache.NotDecomposable:
+            pass
+        else:
+            # The per-day bucket queries run synchronously on a worker thread.
+            return await asyncio.to_thread(_execute, sql_string, maximum_bytes_billed, jobs)
+    return await execute_query_async(
+        sql_string, maximum_bytes_billed, jobs,
+        timeout=deadline.stage_timeout("execution", QUERY_TIMEOUT_SECONDS), short_query=short_query
     )
 
-    sql = response.text
-    if sql:
-        sql = sql.replace("```sql", "").replace("```", "").strip()
+def _job_stats_note(jobs: list) -> str:
+    """Summarizes the statistics of the executed BigQuery job(s)."""
+    if not jobs:
+        return ""
+    stats = [job_stats(job) for job in jobs]
+    logger.info("BigQuery job stats: %s", stats)
+    # Short queries that ran without a job only have a query id.
+    ids = [s["job_id"] or f"query {s['query_id']}" for s in stats]
+    slot_millis = sum(s["slot_millis"] or 0 for s in stats)
+    elapsed = sum(s["elapsed_seconds"] or 0 for s in stats)
+    return (
+        f"\n\nJob stats: {', '.join(ids)}; "
+        f"{format_bytes(sum(s['total_bytes_processed'] or 0 for s in stats))} processed, "
+        f"{format_bytes(sum(s['total_bytes_billed'] or 0 for s in stats))} billed, "
+        f"{slot_millis / 1000:.1f} slot-seconds, {elapsed:.1f}s elapsed"
+        f"{', cache hit' if all(s['cache_hit'] for s in stats) else ''}."
+    )
+
+def _rewrite_query(sql_string: str) -> tuple[str, list[str]]:
+    """Applies the LIMIT and partition-filter rewrite. Returns (sql, changes)."""
+    if not ENFORCE_QUERY_LIMITS:
+        return sql_string, []
+    data_project, dataset = os.getenv("BQ_DATA_PROJECT_ID"), os.getenv("BQ_DATASET_ID")
+    try:
+        table_ids = rewriter.referenced_table_ids(rewriter.parse(sql_string), data_project, dataset)
+        partitioning = get_table_partitioning(table_ids, compute_project_id=os.getenv("BQ_COMPUTE_PROJECT_ID"))
+        return rewriter.rewrite_for_execution(
+            sql_string,
+            partitioning,
+            max_limit=int(os.getenv("BQ_DEFAULT_LIMIT", "200")),
+            default_days=DEFAULT_DAYS,
+            default_project=data_project,
+            default_dataset=dataset,
+        )
+    except Exception as e:
+        logger.warning("Query rewrite skipped: %s", e)
+        return sql_string, []
 
-    return sql
+def _prune_columns(sql_string: str, dry_run_job) -> tuple[str, object, str]:
+    """Runs the column-pruning pass. Returns (sql, dry-run job, note).
 
-def validate_and_execute_query(sql_string: str) -> str:
-    """Validates and then executes the given BigQuery SQL query."""
+    The pruned query is only used if its dry run scans fewer bytes; wide
+    projections are reported either way.
+    """
+    if not PRUNE_COLUMNS:
+        return sql_string, dry_run_job, ""
+    data_project, dataset = os.getenv("BQ_DATA_PROJECT_ID"), os.getenv("BQ_DATASET_ID")
     try:
-        enforce(sql_string, os.getenv('BQ_COMPUTE_PROJECT_ID'))
+        table_ids = rewriter.referenced_table_ids(rewriter.parse(sql_string), data_project, dataset)
+        schema = {}
+        for table_id, metadata in get_table_metadata(table_ids).items():
+            project, dataset_id, table = table_id.split(".")
+            schema.setdefault(project, {}).setdefault(dataset_id, {})[table] = metadata["columns"]
+        pruned, changes, warnings = rewriter.prune_columns(
+            sql_string, schema, data_project, dataset, wide_columns=WIDE_PROJECTION_COLUMNS
+        )
     except Exception as e:
-        return f"Invalid SQL: {e}"
-    
+        logger.info("Column pruning skipped: %s", e)
+        return sql_string, dry_run_job, ""
+
+    note = f"\n\nProjection warning: {'; '.join(warnings)}." if warnings else ""
+    if not changes:
+        return sql_string, dry_run_job, note
     try:
-        results = execute_query(sql_string)
-        return format_results(results)
+        pruned_job = enforce(pruned, os.getenv('BQ_COMPUTE_PROJECT_ID'))
     except Exception as e:
-        return f"Error executing query: {e}"
+        logger.warning("Pruned query failed validation, keeping the original: %s", e)
+        return sql_string, dry_run_job, note
+    before, after = dry_run_job.total_bytes_processed, pruned_job.total_bytes_processed
+    if before is None or after is None or after >= before:
+        return sql_string, dry_run_job, note
+
+    PRUNING_STATS["queries_pruned"] += 1
+    PRUNING_STATS["bytes_saved"] += before - after
+    logger.info("Column pruning saved %s: %s", format_bytes(before - after), "; ".join(changes))
+    note += (
+        f"\n\nColumn pruning: {'; '.join(changes)}. "
+        f"Dry-run bytes: {format_bytes(before)} -> {format_bytes(after)}.\n"
+        f"Executed SQL: {pruned}"
+    )
+    return pruned, pruned_job, note
+
+def _pruning_hint(sql_string: str) -> str:
+    """Names the partition and cluster columns of the tables read by the query."""
+    data_project, dataset = os.getenv("BQ_DATA_PROJECT_ID"), os.getenv("BQ_DATASET_ID")
+    try:
+        table_ids = rewriter.referenced_table_ids(rewriter.parse(sql_string), data_project, dataset)
+    except Exception:
+        return "Add filters or narrow the date range to scan less data."
+    hints = []
+    for table_id, metadata in get_table_metadata(table_ids).items():
+        keys = []
+        if metadata["partitioning"]:
+            keys.append(f"partition column `{metadata['partitioning']['field']}`")
+        if metadata["clustering_fields"]:
+            keys.append("cluster columns " + ", ".join(f"`{c}`" for c in metadata["clustering_fields"]))
+        if keys:
+            hints.append(f"{table_id.split('.')[-1]}: {' and '.join(keys)}")
+    if not hints:
+        return "Add filters, select fewer columns or narrow the date range to scan less data."
+    return f"Filter on {'; '.join(hints)}, or narrow the date range, to scan less data."
+
+def _sample_query(sql_string: str, percent: float) -> tuple[str, str] | None:
+    """Applies TABLESAMPLE to the largest table. Returns (sql, sampled table id) or None if no table qualifies."""
+    data_project, dataset = os.getenv("BQ_DATA_PROJECT_ID"), os.getenv("BQ_DATASET_ID")
+    try:
+        table_ids = rewriter.referenced_table_ids(rewriter.parse(sql_string), data_project, dataset)
+        sizes = {table_id: metadata["num_bytes"] for table_id, metadata in get_table_metadata(table_ids).items()}
+        sampled_sql, sampled_table = rewriter.add_tablesample(sql_string, percent, sizes, data_project, dataset)
+    except Exception as e:
+        logger.warning("Sampling skipped: %s", e)
+        return None
+    if sampled_table is None:
+        return None
+    return sampled_sql, sampled_table
+
+def _sample_error_estimate(jobs: list, percent: float) -> str:
+    """Estimates the relative standard error of totals scaled up from a sample.
+
+    Uses the rows read by the first stage of the query plan, i.e. the sampled rows.
+    """
+    rows_read = 0
+    for job in jobs:
+        plan = getattr(job, "query_plan", None) or []
+        if plan:
+            rows_read += plan[0].records_read or 0
+    if not rows_read:
+        return "Error estimate: unknown (no row statistics for the sample)."
+    relative_error = math.sqrt(max(1 - percent / 100, 0) / rows_read)
+    return (
+        f"Error estimate: about ±{100 * relative_error:.1f}% on totals over all {rows_read:,} sampled rows, "
+        "more for small groups."
+    )
+
+def _finish_exact_query(sql_string: str, handle: str, max_bytes_billed: int | None, estimate, user_id: str):
+    """Runs the exact query in the background and replaces the provisional result under `handle`."""
+    jobs = []
+    try:
+        table = results_lib.to_arrow(_execute(sql_string, max_bytes_billed, jobs))
+        result_store.put(table, handle=handle, owner=user_id)
+        logger.info("Exact result for %s ready (%s rows).", handle, table.num_rows)
+        return table
+    finally:
+        billed = sum(billed_bytes(job) for job in jobs)
+        cost_policy.ledger.record(user_id, estimate, billed)
+
+async def _run_progressive(sql_string: str, decision, estimate, user_id: str) -> str | None:
+    """Answers from a TABLESAMPLE slice now and runs the exact query in the background.
+
+    Returns the provisional result, or None if the query cannot be sampled or the
+    sample fails, in which case the caller runs the exact query directly.
+    """
+    sampled = _sample_query(sql_string, PROGRESSIVE_SAMPLE_PERCENT)
+    if sampled is None:
+        return None
+    sampled_sql, sampled_table = sampled
+    jobs = []
+    try:
+        results = await execute_query_async(
+            sampled_sql, decision.max_bytes_billed, jobs, timeout=deadline.stage_timeout("execution", QUERY_TIMEOUT_SECONDS)
+        )
+        table = await asyncio.to_thread(results_lib.to_arrow, results)
+    except Exception as e:
+        logger.warning("Sampled query failed, running the exact query directly: %s", e)
+        return None
+    finally:
+        billed = sum(billed_bytes(job) for job in jobs)
+        cost_policy.ledger.record(user_id, None, billed, sampled=True)
+
+    handle = result_store.put(table, owner=user_id)
+    with _progressive_lock:
+        _progressive[handle] = (time.monotonic(), _progressive_executor.submit(
+            _finish_exact_query, sql_string, handle, decision.max_bytes_billed, estimate, user_id
+        ))
+        # Forget the oldest finished runs, like the result store forgets old results.
+        finished = [h for h, (_, future) in _progressive.items() if future.done()]
+        for old_handle in finished[: max(len(_progressive) - result_store.max_results, 0)]:
+            del _progressive[old_handle]
+    flag = (
+        f"PROVISIONAL RESULT from a {PROGRESSIVE_SAMPLE_PERCENT:g}% TABLESAMPLE of {sampled_table}: "
+        f"counts and sums cover only the sample (multiply by {100 / PROGRESSIVE_SAMPLE_PERCENT:g} to estimate "
+        f"full totals); averages and ratios need no scaling. {_sample_error_estimate(jobs, PROGRESSIVE_SAMPLE_PERCENT)}\n"
+        f"The exact query is running in the background; call get_exact_result with handle {handle} for the final answer."
+    )
+    return f"{flag}\n\n{_present_result(handle, table)}"
+
+async def _run_approximate_query(sql_string: str, user_id: str) -> tuple[str | None, str | None] | None:
+    """Runs the query with approximate aggregates. Returns None if nothing could be approximated
+    or the approximate query is invalid, so the caller runs the exact one."""
+    try:
+        approx_sql, approximations = rewriter.approximate_aggregates(sql_string)
+    except Exception as e:
+        logger.info("Approximation skipped: %s", e)
+        return None
+    if not approximations:
+        return None
+    result, error = await _run_query(approx_sql, user_id)
+    if error is not None and error.startswith("Invalid SQL"):
+        logger.warning("Approximate query failed validation, running the exact one: %s", error)
+        return None
+    if error is not None:
+        return None, error
+    flag = (
+        f"APPROXIMATE RESULT: {'; '.join(approximations)}. "
+        "The figures are estimates; tell the user they are approximate.\n"
+        f"Executed SQL: {approx_sql}"
+    )
+    return f"{flag}\n\n{result}", None
+
+def _prepare_query(sql_string: str, user_id: str):
+    """Rewrites, validates and prices the query. Returns (sql, decision, estimate, notes, error).
+
+    With BQ_ENFORCE_QUERY_LIMITS and BQ_PRUNE_COLUMNS, the returned SQL is the
+    rewritten one and the notes list the changes made and the dry-run bytes
+    before and after.
+    The dry-run estimate then goes through the cost policy, which may reject the
+    query or switch it to a sample; the job is capped at the remaining budget either way.
+    """
+    compute_project_id = os.getenv('BQ_COMPUTE_PROJECT_ID')
+    rewritten, changes = _rewrite_query(sql_string)
+    notes = ""
+    dry_run_job = None
+    if changes:
+        try:
+            # The original may fail the dry run, e.g. on tables that require a partition filter.
+            bytes_before = dry_run(sql_string, compute_project_id).total_bytes_processed
+        except Exception:
+            bytes_before = None
+        try:
+            dry_run_job = enforce(rewritten, compute_project_id)
+            notes += (
+                f"\n\nQuery rewrite: {'; '.join(changes)}. "
+                f"Dry-run bytes: {format_bytes(bytes_before)} -> {format_bytes(dry_run_job.total_bytes_processed)}.\n"
+                f"Executed SQL: {rewritten}"
+            )
+            sql_string = rewritten
+        except Exception as e:
+            logger.warning("Rewritten query failed validation, running the original: %s", e)
+    if dry_run_job is None:
+        try:
+            dry_run_job = enforce(sql_string, compute_project_id)
+        except deadline.DeadlineExceeded:
+            raise
+        except Exception as e:
+            return sql_string, None, None, notes, f"Invalid SQL: {e}"
+
+    sql_string, dry_run_job, note = _prune_columns(sql_string, dry_run_job)
+    notes += note
+
+    estimate = dry_run_job.total_bytes_processed
+    decision = cost_policy.evaluate(estimate, user_id)
+    if decision.action == "sample":
+        sampled = _sample_query(sql_string, decision.sample_percent)
+        if sampled is None:
+            return sql_string, decision, estimate, notes, f"{decision.message} {_pruning_hint(sql_string)}"
+        sql_string, sampled_table = sampled
+        notes += (
+            f"\n\nSampled execution: the full query was over the byte budget, so it ran on a "
+            f"{decision.sample_percent}% TABLESAMPLE of {sampled_table}. Counts and sums are from the sample, "
+            f"not the full data.\nExecuted SQL: {sql_string}"
+        )
+    elif decision.action != "run":
+        if not decision.message.startswith(cost_policy.OVER_BUDGET_PREFIX):
+            return sql_string, decision, estimate, notes, decision.message
+        return sql_string, decision, estimate, notes, f"{decision.message} {_pruning_hint(sql_string)}"
+    return sql_string, decision, estimate, notes, None
+
+async def _run_query(sql_string: str, user_id: str = "default") -> tuple[str | None, str | None]:
+    """Validates and executes the query. Returns (formatted results, None) or (None, error).
+
+    The dry runs happen on a worker thread and the job is awaited, so other
+    sessions keep running meanwhile.
+    """
+    sql_string, decision, estimate, notes, error = await asyncio.to_thread(_prepare_query, sql_string, user_id)
+    if error is not None:
+        return None, error
+    if decision.action == "run" and PROGRESSIVE_MIN_BYTES and estimate and estimate >= PROGRESSIVE_MIN_BYTES:
+        provisional = await _run_progressive(sql_string, decision, estimate, user_id)
+        if provisional is not None:
+            return provisional + notes, None
+
+    jobs = []
+    try:
+        short_query = SHORT_QUERY_MODE and estimate is not None and estimate <= SHORT_QUERY_MAX_BYTES
+        results = await _execute_async(
+            sql_string, decision.max_bytes_billed, jobs,
+            use_window_cache=decision.action == "run", short_query=short_query,
+        )
+        table = await asyncio.to_thread(results_lib.to_arrow, results)
+        return _present_result(result_store.put(table, owner=user_id), table) + notes + _job_stats_note(jobs), None
+    except Exception as e:
+        return None, f"Error executing query: {e}"
+    finally:
+        billed = sum(billed_bytes(job) for job in jobs)
+        cost_policy.ledger.record(user_id, estimate, billed, sampled=decision.action == "sample")
+
+def _deadline_error(error: deadline.DeadlineExceeded) -> str:
+    return (
+        f"Error: {error}. Tell the user the question could not be answered in time "
+        "and suggest narrowing it (fewer tables, a shorter date range)."
+    )
+
+def _user_question(tool_context: ToolContext) -> str:
+    """Returns the text of the user message that started this invocation."""
+    content = tool_context.user_content
+    if not content or not content.parts:
+        return ""
+    return "\n".join(part.text for part in content.parts if part.text)
+
+def _user_id(tool_context: ToolContext) -> str:
+    """Returns the session's user id, used to charge BigQuery bytes against per-user budgets."""
+    user_id = getattr(tool_context, "user_id", None)
+    if user_id is None:
+        user_id = getattr(getattr(tool_context, "_invocation_context", None), "user_id", None)
+    return user_id or "default"
+
+async def _repair_and_execute(sql_string: str, error: str, tool_context: ToolContext, max_attempts: int) -> str:
+    """Feeds the BigQuery error back to the NL2SQL model until the query runs.
+
+    Bounded by max_attempts and by REPAIR_MAX_SECONDS or the correction share of
+    the question deadline, whichever is shorter. Only the final result
+    and a short repair summary are returned to the agent.
+    """
+    question = _user_question(tool_context)
+    user_id = _user_id(tool_context)
+    # Off the event loop: it may wait for the warm-start prefetch.
+    ddl_schema = (await asyncio.to_thread(ensure_database_settings, tool_context.state))["bq_ddl_schema"]
+    max_rows = os.getenv('BQ_DEFAULT_LIMIT', '200')
+
+    max_seconds = deadline.stage_timeout("correction", REPAIR_MAX_SECONDS)
+    start = time.monotonic()
+    attempts = 0
+    while attempts < max_attempts and time.monotonic() - start < max_seconds and not deadline.expired():
+        attempts += 1
+        try:
+            sql_string = await asyncio.to_thread(
+                repair_sql, llm_model, question, prune_ddl(ddl_schema, sql_string), sql_string, error, max_rows,
+                timeout=max_seconds - (time.monotonic() - start),
+            )
+        except Exception as e:
+            error = f"Error repairing query: {e}"
+            break
+        result, error = await _run_query(sql_string, user_id)
+        if error is None:
+            summary = f"Repair summary: query fixed after {attempts} attempt(s) in {time.monotonic() - start:.1f}s."
+            return f"{result}\n\n{summary}\nExecuted SQL: {sql_string}"
+
+    summary = f"Repair summary: query still failing after {attempts} attempt(s) in {time.monotonic() - start:.1f}s."
+    return f"{error}\n\n{summary}\nLast SQL: {sql_string}"
+
+async def validate_and_execute_query(sql_string: str, tool_context: ToolContext, approximate: bool = False) -> str:
+    """Validates and then executes the given BigQuery SQL query.
+
+    If BQ_REPAIR_MAX_ATTEMPTS is set, a failing query is repaired and re-run inside
+    this tool instead of returning the error to the agent. A query over the byte
+    budget is regenerated at least once when BQ_OVER_BUDGET_ACTION is "regenerate".
+
+    Set `approximate` for exploratory questions ("roughly", "about", "how many
+    distinct ...") to run COUNT(DISTINCT), percentiles and top-k counts with
+    BigQuery's approximate aggregates; the result is then flagged as approximate.
+    """
+    user_id = _user_id(tool_context)
+    try:
+        outcome = None
+        if approximate and APPROXIMATE_AGGREGATES:
+            outcome = await _run_approximate_query(sql_string, user_id)
+        result, error = outcome or await _run_query(sql_string, user_id)
+        signature = tool_context.state.get(COMPLEXITY_SIGNATURE_KEY)
+        if signature is not None:
+            # Feeds the candidate count of similar questions (CHASE_ADAPTIVE_CANDIDATES).
+            complexity.history.record(signature, failed=error is not None)
+            tool_context.state[COMPLEXITY_SIGNATURE_KEY] = None
+        if error is None:
+            return result
+        max_attempts = REPAIR_MAX_ATTEMPTS
+        if error.startswith(cost_policy.OVER_BUDGET_PREFIX) and cost_policy.OVER_BUDGET_ACTION != "reject":
+            max_attempts = max(max_attempts, 1)
+        if max_attempts <= 0:
+            return error
+        return await _repair_and_execute(sql_string, error, tool_context, max_attempts)
+    except deadline.DeadlineExceeded as e:
+        return _deadline_error(e)
 
 def list_bq_datasets() -> list[str]:
     """Lists available BigQuery datasets.
@@ -104,3 +635,109 @@ def list_bq_datasets() -> list[str]:
     if not project_id:
         return ["Error: BQ_DATA_PROJECT_ID environment variable is not set."]
     return list_bigquery_datasets(project_id)
+
+async def answer_question(question: str, tool_context: ToolContext, approximate: bool = False) -> str:
+    """Answers a data question in a single call.
+
+    Resolves the dataset(s), loads the prefetched schema, generates the SQL, then
+    validates and executes it. Returns the executed SQL followed by the results.
+    `approximate` is passed on to `validate_and_execute_query`.
+    """
+    if not os.getenv("BQ_DATA_PROJECT_ID"):
+        return "Error: BQ_DATA_PROJECT_ID environment variable is not set."
+
+    try:
+        # Prefetched by the warm-start callback; only waits (in a worker thread) if that is still running.
+        ddl_schema = (await asyncio.to_thread(ensure_database_settings, tool_context.state))["bq_ddl_schema"]
+    except deadline.DeadlineExceeded as e:
+        return _deadline_error(e)
+    if not ddl_schema:
+        return "Error: no schema found for the configured dataset(s)."
+
+    MAX_NUM_ROWS = os.getenv('BQ_DEFAULT_LIMIT', '200')
+    try:
+        sql = await asyncio.to_thread(_generate_sql, question, ddl_schema, MAX_NUM_ROWS)
+    except deadline.DeadlineExceeded as e:
+        return _deadline_error(e)
+    except Exception as e:
+        return f"Error generating SQL: {e}"
+
+    result = await validate_and_execute_query(sql, tool_context, approximate)
+    return f"SQL: {sql}\n\n{result}"
+
+async def get_exact_result(result_handle: str, tool_context: ToolContext, wait_seconds: float = 0) -> str:
+    """Returns the exact result behind a PROVISIONAL RESULT handle once its background query finishes.
+
+    Waits up to `wait_seconds` for it; if it is still running, says so and how long it has run.
+    """
+    if not result_store.owns(result_handle, _user_id(tool_context)):
+        return f"Error: Unknown result handle '{result_handle}'."
+    with _progressive_lock:
+        run = _progressive.get(result_handle)
+    if run is None:
+        return f"Result {result_handle} is not provisional; it is already exact."
+    started, future = run
+    if not future.done() and wait_seconds > 0:
+        try:
+            # shield() keeps the background query running when the wait times out.
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout=wait_seconds)
+        except Exception:
+            pass  # Reported below from the future itself.
+    if not future.done():
+        return (
+            f"The exact query for {result_handle} is still running ({time.monotonic() - started:.0f}s so far). "
+            "The provisional result stays available under the same handle."
+        )
+    try:
+        table = future.result()
+    except Exception as e:
+        return f"Error executing the exact query for {result_handle}: {e}. The provisional result is unchanged."
+    return f"EXACT RESULT (replaces the provisional one):\n{_present_result(result_handle, table)}"
+
+def page_result(result_handle: str, offset: int, limit: int, tool_context: ToolContext) -> str:
+    """Returns `limit` rows of a stored query result starting at `offset`, without querying BigQuery."""
+    try:
+        table = result_store.get(result_handle, _user_id(tool_context))
+    except KeyError as e:
+        return f"Error: {e}"
+    try:
+        rows = results_lib.page(table, offset, limit).to_pylist()
+    except Exception as e:
+        return f"Error paging {result_handle}: {e}"
+    return f"Rows {offset}-{offset + len(rows) - 1} of {table.num_rows} in {result_handle}:\n{_format_rows(rows)}"
+
+def filter_result(result_handle: str, column: str, operator: str, value: str, tool_context: ToolContext) -> str:
+    """Filters a stored query result locally and returns a new result handle.
+
+    `operator` is one of =, !=, >, >=, <, <=, contains, in (comma-separated values).
+    """
+    owner = _user_id(tool_context)
+    try:
+        table = results_lib.filter_rows(result_store.get(result_handle, owner), column, operator, value)
+    except Exception as e:
+        return f"Error filtering {result_handle}: {e}"
+    return _present_result(result_store.put(table, owner=owner), table)
+
+def sort_result(result_handle: str, column: str, descending: bool, tool_context: ToolContext) -> str:
+    """Sorts a stored query result locally by one column and returns a new result handle."""
+    owner = _user_id(tool_context)
+    try:
+        table = results_lib.sort(result_store.get(result_handle, owner), column, descending)
+    except Exception as e:
+        return f"Error sorting {result_handle}: {e}"
+    return _present_result(result_store.put(table, owner=owner), table)
+
+def aggregate_result(result_handle: str, group_by: str, column: str, function: str, tool_context: ToolContext) -> str:
+    """Groups a stored query result locally and aggregates one column; returns a new result handle.
+
+    `group_by` is a comma-separated list of columns; `column:day`, `column:month` or
+    `column:year` buckets a date/timestamp column. `function` is one of sum, mean,
+    min, max, count, count_distinct.
+    """
+    keys = [key.strip() for key in group_by.split(",") if key.strip()]
+    owner = _user_id(tool_context)
+    try:
+        table = results_lib.aggregate(result_store.get(result_handle, owner), keys, column, function)
+    except Exception as e:
+        return f"Error aggregating {result_handle}: {e}"
+    return _present_result(result_store.put(table, owner=owner), table)
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The modules import each other from src/, like `python -m tools.benchmarks` run there.
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,44 @@
+import time
+
+import pyarrow as pa
+import pytest
+
+from tools.benchmarks import FakeGeminiModel
+from tools.llm_cache import ResponseCache
+
+
+def test_call_parallel_returns_at_timeout():
+    """The slow call is reported as timed out without call_parallel waiting for it."""
+    pytest.importorskip("vertexai")
+    from sub_agents.bigquery.chase_sql.llm_utils import TIMEOUT_RESPONSE, GeminiModel
+
+    timeout = 0.5
+    model = FakeGeminiModel({"fast": timeout / 5, "slow": 5.0})
+    start = time.perf_counter()
+    results = GeminiModel.call_parallel(model, ["fast", "slow"], timeout=timeout)
+    elapsed = time.perf_counter() - start
+    assert results == ["response to fast", TIMEOUT_RESPONSE]
+    assert elapsed < timeout + 0.2
+
+
+def test_all_null_column_stats():
+    """A LEFT JOIN without matches gives an all-null column; its min, max and mean are None."""
+    pytest.importorskip("google.adk")
+    from sub_agents.bigquery.tools import RESULT_PREVIEW_ROWS, _present_result
+
+    num_rows = RESULT_PREVIEW_ROWS + 1
+    table = pa.table({"id": list(range(num_rows)), "value": pa.nulls(num_rows, pa.float64())})
+    stats = _present_result("r1", table).split("stats over all rows (count, min, max, mean):\n")[1]
+    assert "  value: 0, n/a, n/a, n/a" in stats
+
+
+def test_llm_cache_evicts_least_recently_used(tmp_path):
+    max_bytes, entries = 10_000, 30
+    cache = ResponseCache(str(tmp_path / "llm_cache.sqlite"), max_bytes)
+    for index in range(entries):
+        cache.put(f"key{index}", "model", "x" * 1_000)
+        time.sleep(0.001)  # Distinct access times.
+        assert cache.get("key0") is not None, "the most recently read response was evicted"
+    assert cache.stats()["bytes"] <= max_bytes
+    assert cache.get(f"key{entries - 1}") is not None, "the newest response was evicted"
+    assert cache.get("key1") is None, "the least recently used response was kept"
@@ -1,3 +1,7 @@
+from collections import Counter
+from decimal import Decimal
+
+
 def format_results(results):
     """Formats BigQuery results into a human-readable string."""
     rows = list(results)
@@ -19,3 +23,91 @@ def format_results(results):
                 output += f"{key}: {value}, "
             output = output.strip(", ") + "\n"
         return output
+
+
+def format_bytes(num_bytes):
+    """Formats a byte count as B/KB/MB/GB/TB; None becomes "unknown"."""
+    if num_bytes is None:
+        return "unknown"
+    for unit in ("B", "KB", "MB", "GB"):
+        if num_bytes < 1024:
+            return f"{num_bytes:.0f} {unit}" if unit == "B" else f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TB"
+
+
+def _is_number(value):
+    return isinstance(value, (int, float, Decimal)) and not isinstance(value, bool)
+
+
+def _format_number(value, precision):
+    if isinstance(value, int):
+        return str(value)
+    text = f"{float(value):.{precision}f}"
+    return text.rstrip("0").rstrip(".") if "." in text else text
+
+
+def _format_value(value, precision):
+    if value is None:
+        return ""
+    if _is_number(value):
+        return _format_number(value, precision)
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value).replace("|", "/").replace("\n", " ")
+
+
+def format_results_compact(results, precision=4, stats_threshold=50):
+    """Formats BigQuery results in a token-efficient encoding for the model context.
+
+    The column header is written once, columns holding a single value are stated once,
+    and rows are pipe-delimited. Strings that repeat
+    (constraint names, nodes, markets) are replaced by `@n` codes defined once in a
+    dictionary line, floats use a fixed precision, and results with more than
+    `stats_threshold` rows are followed by count/min/max/mean per numeric column.
+    """
+    rows = list(results)
+    if not rows:
+        return "No results found."
+
+    columns = list(rows[0].keys())
+    table = [list(row.values()) for row in rows]
+
+    # Columns with a single value (e.g. marketName = MISO) are stated once.
+    constant = []
+    if len(rows) > 1:
+        constant = [i for i in range(len(columns)) if all(row[i] == table[0][i] for row in table)]
+        if len(constant) == len(columns):
+            constant = []
+    constant_line = ", ".join(f"{columns[i]}={_format_value(table[0][i], precision)}" for i in constant)
+    columns = [c for i, c in enumerate(columns) if i not in constant]
+    table = [[v for i, v in enumerate(row) if i not in constant] for row in table]
+
+    # Dictionary-encode strings that repeat and are longer than their code.
+    counts = Counter(v for row in table for v in row if isinstance(v, str))
+    codes = {}
+    for value, count in counts.most_common():
+        code = f"@{len(codes)}"
+        if count < 2 or len(value) <= len(code):
+            continue
+        codes[value] = code
+
+    lines = [f"rows: {len(rows)}"]
+    if constant_line:
+        lines.append(f"same in every row: {constant_line}")
+    lines.append("columns: " + "|".join(columns))
+    if codes:
+        lines.append("dict: " + "; ".join(f"{code}={_format_value(value, precision)}" for value, code in codes.items()))
+    for row in table:
+        cells = [codes[v] if isinstance(v, str) and v in codes else _format_value(v, precision) for v in row]
+        lines.append("|".join(cells))
+
+    if len(rows) > stats_threshold:
+        lines.append("stats (count, min, max, mean):")
+        for index, column in enumerate(columns):
+            values = [float(row[index]) for row in table if _is_number(row[index])]
+            if not values:
+                continue
+            stats = (min(values), max(values), sum(values) / len(values))
+            lines.append(f"  {column}: {len(values)}, " + ", ".join(_format_number(v, precision) for v in stats))
+    return "\n".join(lines)
@@ -0,0 +1,145 @@
+"""Offline benchmarks for the tool layer. Run from src/: python -m tools.benchmarks"""
+import asyncio
+import random
+import re
+import statistics
+import time
+from datetime import date, timedelta
+from tools.answers import format_results, format_results_compact
+
+
+def estimate_tokens(text):
+    """Rough token count: words, numbers and punctuation each count as one token."""
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+
+def sample_constraint_rows(num_rows=200, seed=0):
+    """Synthetic rows shaped like the MISO daily constraint summary."""
+    rng = random.Random(seed)
+    constraints = [f"CONSTRAINT_{i:03d} FLO LINE_{i * 7 % 97}" for i in range(12)]
+    start = date(2025, 8, 1)
+    rows = []
+    for i in range(num_rows):
+        rows.append({
+            "marketName": "MISO",
+            "constraintName": rng.choice(constraints),
+            "operatingDate": start + timedelta(days=i % 30),
+            "RTPrice": rng.uniform(-500, 0),
+            "ISOPrice": rng.uniform(-300, 0),
+        })
+    return rows
+
+
+def benchmark_result_formats(rows, count_tokens=estimate_tokens):
+    """Returns the token counts of format_results and format_results_compact for the rows.
+
+    Pass e.g. `lambda text: model.count_tokens(text).total_tokens` for exact model counts.
+    """
+    legacy = count_tokens(format_results(rows))
+    compact = count_tokens(format_results_compact(rows))
+    return {"legacy": legacy, "compact": compact, "saving": 1 - compact / legacy}
+
+
+class _FakeRows(list):
+    def __init__(self, rows, job_id, query_id):
+        super().__init__(rows)
+        self.job_id = job_id
+        self.query_id = query_id
+
+
+class _FakeJob:
+    def __init__(self, client, finishes_at):
+        self.client = client
+        self.finishes_at = finishes_at
+        self.job_id = "fake_job"
+
+    def done(self):
+        time.sleep(self.client.rtt)  # jobs.get
+        return time.monotonic() >= self.finishes_at
+
+    def result(self):
+        time.sleep(self.client.rtt)  # jobs.getQueryResults with the first page of rows
+        return _FakeRows(self.client.rows, self.job_id, None)
+
+    def cancel(self):
+        time.sleep(self.client.rtt)
+
+
+class FakeBigQueryClient:
+    """Local fake of the BigQuery API for latency benchmarks.
+
+    Every API call costs one round trip of `rtt` seconds and a query runs for
+    `runtime` seconds server-side. query_and_wait() behaves like job-optional
+    mode: rows come back in the jobs.query call if the query finishes within
+    `short_query_timeout`, otherwise a job is created and polled.
+    """
+
+    def __init__(self, rtt=0.03, runtime=0.2, short_query_timeout=10.0, rows=None):
+        self.rtt = rtt
+        self.runtime = runtime
+        self.short_query_timeout = short_query_timeout
+        self.rows = rows if rows is not None else sample_constraint_rows(20)
+
+    def query(self, sql, job_config=None):
+        time.sleep(self.rtt)  # jobs.insert
+        return _FakeJob(self, time.monotonic() + self.runtime)
+
+    def query_and_wait(self, sql, job_config=None, wait_timeout=None):
+        time.sleep(self.rtt + min(self.runtime, self.short_query_timeout))  # jobs.query
+        if self.runtime <= self.short_query_timeout:
+            return _FakeRows(self.rows, None, "fake_query")
+        job = _FakeJob(self, time.monotonic() + self.runtime - self.short_query_timeout)
+        while not job.done():
+            pass
+        return job.result()
+
+
+def benchmark_query_modes(rtt=0.03, runtimes=(0.05, 0.2, 1.0), repeats=5):
+    """Median latency of the job-based and short-query paths of execute_query_async against FakeBigQueryClient.
+
+    Returns {runtime: {"job": seconds, "short": seconds}}.
+    """
+    from tools.bigquery_io import execute_query_async
+
+    async def timed(client, short_query):
+        start = time.perf_counter()
+        await execute_query_async("SELECT 1", client=client, short_query=short_query)
+        return time.perf_counter() - start
+
+    results = {}
+    for runtime in runtimes:
+        client = FakeBigQueryClient(rtt=rtt, runtime=runtime)
+        results[runtime] = {
+            mode: statistics.median(asyncio.run(timed(client, mode == "short")) for _ in range(repeats))
+            for mode in ("job", "short")
+        }
+    return results
+
+
+class FakeGeminiModel:
+    """Local stand-in for GeminiModel whose calls sleep for a per-prompt latency."""
+
+    def __init__(self, latencies):
+        self.latencies = latencies  # prompt -> seconds
+
+    def call(self, prompt, parser_func=None, stop_after_sql_block=False, cache=None):
+        time.sleep(self.latencies[prompt])
+        return f"response to {prompt}"
+
+
+def main():
+    for num_rows in (5, 50, 500):
+        result = benchmark_result_formats(sample_constraint_rows(num_rows))
+        print(
+            f"{num_rows:>4} rows: legacy {result['legacy']:>6} tokens, "
+            f"compact {result['compact']:>6} tokens ({result['saving']:.0%} fewer)"
+        )
+    for runtime, latency in benchmark_query_modes().items():
+        print(
+            f"query running {runtime:.2f}s: job path {latency['job']:.3f}s, "
+            f"short query {latency['short']:.3f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,169 @@
 from google.cloud import bigquery
+import asyncio
+import concurrent.futures
+import datetime
+import logging
 import os
+import threading
+import time
+import uuid
 
-def execute_query(sql: str):
-    """Executes a BigQuery query and returns the results."""
+logger = logging.getLogger(__name__)
+
+# Seconds between job status checks in execute_query_async.
+POLL_INTERVAL_SECONDS = float(os.getenv("BQ_POLL_INTERVAL_SECONDS", "0.5"))
+
+def short_query_client(project: str | None = None):
+    """Returns a client that runs queries in job-optional (short query) mode.
+
+    Returns None if the installed client version does not support the mode.
+    """
+    project = project or os.getenv('BQ_COMPUTE_PROJECT_ID')
+    try:
+        return bigquery.Client(project=project, default_job_creation_mode="JOB_CREATION_OPTIONAL")
+    except TypeError:
+        logger.warning("google-cloud-bigquery does not support job-optional queries; running a regular job.")
+        return None
+
+def _cancel(query_job, reason: str):
+    try:
+        query_job.cancel()
+        logger.info("Cancelled BigQuery job %s: %s", query_job.job_id, reason)
+    except Exception as e:
+        logger.warning("Could not cancel BigQuery job %s: %s", query_job.job_id, e)
+
+def execute_query(sql: str, maximum_bytes_billed: int | None = None, jobs: list | None = None,
+                  timeout: float | None = None):
+    """Executes a BigQuery query and returns the results.
+
+    `maximum_bytes_billed` makes BigQuery fail the job instead of billing more.
+    The finished job is appended to `jobs` if given, e.g. to read `total_bytes_billed`.
+    The job is cancelled and TimeoutError raised if it runs longer than `timeout` seconds.
+    """
     client = bigquery.Client(project=os.getenv('BQ_COMPUTE_PROJECT_ID'))
-    query_job = client.query(sql)
-    results = query_job.result()
+    job_config = bigquery.QueryJobConfig(maximum_bytes_billed=maximum_bytes_billed)
+    query_job = client.query(sql, job_config=job_config)
+    if jobs is not None:
+        jobs.append(query_job)
+    try:
+        results = query_job.result(timeout=timeout)
+    except concurrent.futures.TimeoutError as e:
+        _cancel(query_job, "deadline exceeded")
+        raise TimeoutError(f"BigQuery job {query_job.job_id} did not finish within {timeout:g}s; it was cancelled.") from e
     return results
+
+# Label that ties a job BigQuery created for a short query back to the call that submitted it.
+SHORT_QUERY_LABEL = "short_query_token"
+
+def _cancel_short_query_job(client, token: str, submitted_at, reason: str, jobs: list | None = None):
+    """Cancels the job BigQuery created for a short query, if it created one.
+
+    query_and_wait only returns the job once it has finished, so the job is
+    looked up among the caller's running jobs by its SHORT_QUERY_LABEL.
+    """
+    try:
+        for job in client.list_jobs(min_creation_time=submitted_at, state_filter="running", max_results=100):
+            if (getattr(job, "labels", None) or {}).get(SHORT_QUERY_LABEL) == token:
+                if jobs is not None:
+                    jobs.append(job)
+                _cancel(job, reason)
+    except Exception as e:
+        logger.warning("Could not look up the job of short query %s: %s", token, e)
+
+async def _execute_short_query(client, sql: str, job_config, jobs: list | None, timeout: float | None):
+    """Runs the query through jobs.query in job-optional mode.
+
+    Short queries return their rows in that single call without creating a job.
+    Longer ones get a job from BigQuery, which query_and_wait then polls, and
+    which is cancelled after `timeout` seconds or when the awaiting task is
+    cancelled. Failed queries that ran as a job are appended to `jobs` too.
+    """
+    token = uuid.uuid4().hex
+    job_config.labels = {**(job_config.labels or {}), SHORT_QUERY_LABEL: token}
+    # Allow for clock skew between this host and BigQuery in the job lookup.
+    submitted_at = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=1)
+    kwargs = {"wait_timeout": timeout} if timeout is not None else {}
+    try:
+        results = await asyncio.to_thread(client.query_and_wait, sql, job_config=job_config, **kwargs)
+    except asyncio.CancelledError:
+        # Don't await anything else here: the task is being torn down.
+        threading.Thread(
+            target=_cancel_short_query_job, args=(client, token, submitted_at, "request cancelled"), daemon=True
+        ).start()
+        raise
+    except concurrent.futures.TimeoutError as e:
+        await asyncio.to_thread(_cancel_short_query_job, client, token, submitted_at, "deadline exceeded", jobs)
+        raise TimeoutError(f"BigQuery query did not finish within {timeout:g}s; it was cancelled.") from e
+    except Exception as e:
+        # Errors of a query that ran as a job carry it, with the bytes it billed.
+        if jobs is not None and getattr(e, "query_job", None) is not None:
+            jobs.append(e.query_job)
+        raise
+    if jobs is not None:
+        jobs.append(results)
+    # The query id identifies job-less queries in the audit logs.
+    logger.info("BigQuery query: query_id=%s job_id=%s", getattr(results, "query_id", None), results.job_id)
+    return results
+
+async def execute_query_async(
+    sql: str,
+    maximum_bytes_billed: int | None = None,
+    jobs: list | None = None,
+    timeout: float | None = None,
+    short_query: bool = False,
+    client=None,
+):
+    """Submits a BigQuery query and awaits it without blocking the event loop.
+
+    The job is polled from a worker thread every POLL_INTERVAL_SECONDS. It is
+    cancelled in BigQuery when `timeout` seconds pass (raising TimeoutError) or
+    when the awaiting task is cancelled, e.g. because the user disconnected.
+    With `short_query` the query runs in job-optional mode instead (see
+    _execute_short_query), which saves the job round trips on small lookups.
+    Returns the results like execute_query.
+    """
+    if client is None and short_query:
+        client = short_query_client()
+        short_query = client is not None
+    if client is None:
+        client = bigquery.Client(project=os.getenv('BQ_COMPUTE_PROJECT_ID'))
+    job_config = bigquery.QueryJobConfig(maximum_bytes_billed=maximum_bytes_billed)
+    if short_query:
+        return await _execute_short_query(client, sql, job_config, jobs, timeout)
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    query_job = await asyncio.to_thread(client.query, sql, job_config=job_config)
+    if jobs is not None:
+        jobs.append(query_job)
+    try:
+        while not await asyncio.to_thread(query_job.done):
+            if deadline is not None and time.monotonic() >= deadline:
+                await asyncio.to_thread(_cancel, query_job, "deadline exceeded")
+                raise TimeoutError(f"BigQuery job {query_job.job_id} did not finish within {timeout:g}s; it was cancelled.")
+            await asyncio.sleep(POLL_INTERVAL_SECONDS)
+    except asyncio.CancelledError:
+        # Don't await anything else here: the task is being torn down.
+        _cancel(query_job, "request cancelled")
+        raise
+    return await asyncio.to_thread(query_job.result)
+
+def billed_bytes(query) -> int:
+    """Bytes billed for a finished job.
+
+    The RowIterator of a short query has no total_bytes_billed, so for those this
+    is the bytes processed instead: close to, but not, the billed figure (it
+    ignores the per-table billing minimum).
+    """
+    return getattr(query, "total_bytes_billed", None) or getattr(query, "total_bytes_processed", None) or 0
+
+def job_stats(query) -> dict:
+    """Returns the statistics of a finished query job, or of the RowIterator of a short query, as a plain dict."""
+    started, ended = getattr(query, "started", None), getattr(query, "ended", None)
+    return {
+        "job_id": query.job_id,
+        "query_id": getattr(query, "query_id", None),
+        "total_bytes_processed": getattr(query, "total_bytes_processed", None),
+        "total_bytes_billed": billed_bytes(query),
+        "slot_millis": getattr(query, "slot_millis", None),
+        "elapsed_seconds": (ended - started).total_seconds() if started and ended else None,
+        "cache_hit": getattr(query, "cache_hit", None),
+    }
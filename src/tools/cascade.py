@@ -0,0 +1,177 @@
+import logging
+import os
+import threading
+import time
+from collections import Counter
+import sqlglot
+from sqlglot import exp
+from tools import deadline
+from tools.rewriter import parse
+from tools.schema import ddl_columns, ddl_table_ids
+from tools.validator import enforce
+
+logger = logging.getLogger(__name__)
+
+# Dry-run the cheap model's query before accepting it (dry runs are free).
+CASCADE_DRY_RUN = os.getenv("NL2SQL_CASCADE_DRY_RUN", "True").lower() in ("true", "1", "t")
+
+
+def _qualifies(table, table_ids):
+    """True if the table's dataset and project qualifiers, where given, match a table in the DDL."""
+    qualifiers = [part.lower() for part in (table.catalog, table.db) if part]
+    for table_id in table_ids:
+        parts = table_id.lower().split(".")
+        if parts[-1] == table.name.lower() and parts[-1 - len(qualifiers):-1] == qualifiers:
+            return True
+    return False
+
+
+def local_check(sql, ddl_schema):
+    """Checks a generated query against the schema without calling BigQuery.
+
+    Returns a list of problems: a parse error, a statement that is not a query,
+    or tables and columns that are not in the DDL. Empty when the query looks fine.
+    Only top-level columns are checked: STRUCT fields and the elements of
+    UNNESTed arrays are not in the DDL column list.
+    """
+    if not sql or not sql.strip():
+        return ["empty response"]
+    try:
+        ast = parse(sql)
+    except sqlglot.errors.SqlglotError as e:
+        return [f"does not parse: {e}"]
+    if not isinstance(ast, exp.Query):
+        return ["not a SELECT query"]
+
+    tables = {
+        table.lower(): {column.lower() for column in columns} for table, columns in ddl_columns(ddl_schema).items()
+    }
+    table_ids = ddl_table_ids(ddl_schema)
+    cte_names = {cte.alias_or_name.lower() for cte in ast.find_all(exp.CTE)}
+    problems, known = [], set(cte_names)
+    for table in ast.find_all(exp.Table):
+        name = table.name.lower()
+        if name in cte_names and not table.db:
+            continue
+        if "information_schema" in table.db.lower():
+            return []
+        if name not in tables or not _qualifies(table, table_ids):
+            problems.append(f"unknown table {table.sql('bigquery')}")
+        known |= tables.get(name, set())
+    if problems:
+        return problems
+
+    # Names the query defines itself: output aliases, table aliases and their column lists.
+    relations = {table.alias_or_name.lower() for table in ast.find_all(exp.Table)} | cte_names
+    for alias in ast.find_all(exp.Alias):
+        known.add(alias.alias.lower())
+    for table_alias in ast.find_all(exp.TableAlias):
+        relations.add(table_alias.name.lower())
+        known.add(table_alias.name.lower())
+        known |= {column.name.lower() for column in table_alias.columns}
+    unnested = set()
+    for unnest in ast.find_all(exp.Unnest):
+        alias = unnest.args.get("alias")
+        if alias:
+            unnested |= {alias.name.lower()} | {column.name.lower() for column in alias.columns}
+
+    unknown = set()
+    for column in ast.find_all(exp.Column):
+        parts = [part.name for part in column.parts]
+        if len(parts) > 1 and parts[0].lower() in unnested:
+            continue  # A field of an UNNESTed STRUCT element.
+        if len(parts) > 1 and parts[0].lower() in relations:
+            parts = parts[1:]
+        # The first remaining part is the column; any further parts are STRUCT fields.
+        if parts[0].lower() not in known:
+            unknown.add(parts[0])
+    return [f"unknown column {name}" for name in sorted(unknown)]
+
+
+def escalation_reason(sql, ddl_schema, compute_project_id=None):
+    """Returns why a cheap model's query should go to the larger model, or None to accept it."""
+    problems = local_check(sql, ddl_schema)
+    if problems:
+        logger.info("Cascade local check failed: %s", "; ".join(problems))
+        return "local_check"
+    if CASCADE_DRY_RUN:
+        try:
+            enforce(sql, compute_project_id or os.getenv("BQ_COMPUTE_PROJECT_ID"))
+        except deadline.DeadlineExceeded:
+            raise
+        except Exception as e:
+            logger.info("Cascade dry run failed: %s", e)
+            return "dry_run"
+    return None
+
+
+class CascadeStats:
+    """How often the cheap model's query was accepted, and calls, latency and tokens per model."""
+
+    def __init__(self):
+        self._questions = 0
+        self._escalations = Counter()  # reason -> questions
+        self._models = {}  # model name -> Counter of calls, seconds, prompt/output tokens
+        self._lock = threading.Lock()
+
+    def record_call(self, model, seconds, usage=()):
+        """Records one generation; `usage` holds the usage_metadata of its responses, if known."""
+        with self._lock:
+            counter = self._models.setdefault(model, Counter())
+            counter["calls"] += 1
+            counter["seconds"] += seconds
+            for metadata in usage:
+                counter["prompt_tokens"] += getattr(metadata, "prompt_token_count", 0) or 0
+                counter["output_tokens"] += getattr(metadata, "candidates_token_count", 0) or 0
+
+    def record_question(self, escalation_reason=None):
+        with self._lock:
+            self._questions += 1
+            if escalation_reason is not None:
+                self._escalations[escalation_reason] += 1
+
+    def stats(self):
+        with self._lock:
+            escalated = sum(self._escalations.values())
+            return {
+                "questions": self._questions,
+                "escalations": escalated,
+                "escalation_rate": escalated / self._questions if self._questions else None,
+                "escalation_reasons": dict(self._escalations),
+                "models": {model: dict(counter) for model, counter in self._models.items()},
+            }
+
+
+stats = CascadeStats()
+
+
+def generate(cheap, strong, validate):
+    """Generates SQL with the cheap model first and escalates to the strong one if needed.
+
+    `cheap` and `strong` are (model name, generate) pairs, where generate(usage)
+    returns the SQL and may append response usage metadata to `usage`.
+    validate(sql) returns an escalation reason or None (see escalation_reason).
+    Errors of the cheap model escalate too; those of the strong one propagate.
+    """
+    (cheap_model, cheap_generate), (strong_model, strong_generate) = cheap, strong
+    start, usage = time.monotonic(), []
+    try:
+        sql = cheap_generate(usage)
+        reason = validate(sql)
+    except deadline.DeadlineExceeded:
+        raise
+    except Exception as e:
+        logger.info("Cascade model %s failed: %s", cheap_model, e)
+        reason = "error"
+    stats.record_call(cheap_model, time.monotonic() - start, usage)
+    if reason is None:
+        stats.record_question()
+        return sql
+
+    logger.info("Escalating from %s to %s: %s", cheap_model, strong_model, reason)
+    stats.record_question(reason)
+    start, usage = time.monotonic(), []
+    try:
+        return strong_generate(usage)
+    finally:
+        stats.record_call(strong_model, time.monotonic() - start, usage)
@@ -0,0 +1,114 @@
+import re
+import threading
+from collections import Counter
+from tools.schema import ddl_columns
+
+# Question phrases that make a query harder to get right, by signal.
+_SIGNALS = {
+    "aggregation": r"\b(total|sum|average|avg|mean|median|count|how many|max(imum)?|min(imum)?|top \d*|rank|percentile|per|each)\b",
+    "time_window": r"\b(last|past|previous|since|between|during|trend|over time|daily|weekly|monthly|yearly|year[- ]over[- ]year|(19|20)\d\d)\b",
+    "comparison": r"\b(compare|compared|versus|vs\.?|ratio|share|percent(age)? of|difference|change|growth|more than|less than)\b",
+}
+
+# Signatures seen fewer times than this don't count towards the failure rate.
+MIN_HISTORY = 3
+
+
+def _signature(tables, signals):
+    # Questions with the same tables and signals count as similar for the failure history.
+    return "|".join(sorted(tables)) + ":" + ",".join(sorted(signals))
+
+
+class Complexity:
+    """Estimated difficulty of a question, from the schema it touches and its wording."""
+
+    def __init__(self, tables, signals, failure_rate):
+        self.tables = tables  # Tables whose name or columns the question mentions.
+        self.signals = signals
+        self.failure_rate = failure_rate  # Of earlier questions with the same signature, or None.
+        self.score = max(len(tables) - 1, 0) + len(signals) + (2 * failure_rate if failure_rate else 0)
+
+    @property
+    def signature(self):
+        return _signature(self.tables, self.signals)
+
+    def __repr__(self):
+        return f"Complexity(score={self.score:.1f}, tables={sorted(self.tables)}, signals={sorted(self.signals)})"
+
+
+class FailureHistory:
+    """Executions and failures per question signature."""
+
+    def __init__(self):
+        self._counts = {}  # signature -> [executions, failures]
+        self._lock = threading.Lock()
+
+    def record(self, signature, failed):
+        with self._lock:
+            counts = self._counts.setdefault(signature, [0, 0])
+            counts[0] += 1
+            counts[1] += int(failed)
+
+    def failure_rate(self, signature):
+        with self._lock:
+            executions, failures = self._counts.get(signature, (0, 0))
+        return failures / executions if executions >= MIN_HISTORY else None
+
+
+history = FailureHistory()
+
+
+def _split_identifier(name):
+    """Splits camelCase and snake_case identifiers into lowercase words."""
+    return [word.lower() for word in re.findall(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+", name)]
+
+
+def _stem(word):
+    return word[:-1] if word.endswith("s") and len(word) > 3 else word
+
+
+def _mentions(question_words, identifier):
+    words = [_stem(word) for word in _split_identifier(identifier) if len(word) > 2]
+    return bool(words) and all(word in question_words for word in words)
+
+
+def estimate(question, ddl_schema):
+    """Estimates how hard the question is to translate to SQL against the schema.
+
+    Counts the tables the question refers to (by table name or a column only that
+    table has; more than one implies joins), aggregation, time-window and comparison wording, and the failure rate
+    of earlier questions with the same tables and wording.
+    """
+    question_lower = question.lower()
+    question_words = {_stem(word) for word in re.findall(r"[a-z0-9]+", question_lower)}
+    schema = ddl_columns(ddl_schema)
+    # Columns in several tables (join keys) don't tell which table is meant.
+    column_tables = Counter(column for columns in schema.values() for column in columns)
+    tables = set()
+    for table, columns in schema.items():
+        if _mentions(question_words, table) or any(
+            column_tables[column] == 1 and _mentions(question_words, column) for column in columns
+        ):
+            tables.add(table)
+    signals = {name for name, pattern in _SIGNALS.items() if re.search(pattern, question_lower)}
+    return Complexity(tables, signals, history.failure_rate(_signature(tables, signals)))
+
+
+def plan_generation(complexity, max_candidates, default_type="dc"):
+    """Returns (number of candidates, generation type) for a question.
+
+    Simple lookups get a single candidate of the default type. Questions that
+    join tables are planned with QP, multi-step aggregations and comparisons
+    with DC, and only the hardest get `max_candidates`. With the "ensemble"
+    default, simple lookups get one DC candidate and the rest stay in the ensemble.
+    """
+    if complexity.score <= 1:
+        return 1, "dc" if default_type == "ensemble" else default_type
+    candidates = max_candidates if complexity.score >= 3 else min(2, max_candidates)
+    if default_type == "ensemble":
+        return candidates, default_type
+    if len(complexity.tables) > 1:
+        return candidates, "qp"
+    if "comparison" in complexity.signals or {"aggregation", "time_window"} <= complexity.signals:
+        return candidates, "dc"
+    return candidates, default_type
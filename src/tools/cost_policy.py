@@ -0,0 +1,125 @@
+import datetime
+import logging
+import os
+import threading
+from collections import deque
+from tools.answers import format_bytes
+
+logger = logging.getLogger(__name__)
+
+# Byte budgets; 0 disables a budget. Daily budgets reset at midnight UTC.
+MAX_BYTES_PER_QUERY = int(os.getenv("BQ_MAX_BYTES", "0"))
+USER_DAILY_BYTES = int(os.getenv("BQ_USER_DAILY_BYTES", "0"))
+DEPLOYMENT_DAILY_BYTES = int(os.getenv("BQ_DEPLOYMENT_DAILY_BYTES", "0"))
+
+# What to do with a query whose dry-run estimate exceeds the budget:
+# "reject", "regenerate" (ask the NL2SQL model for a tighter query) or "sample".
+OVER_BUDGET_ACTION = os.getenv("BQ_OVER_BUDGET_ACTION", "regenerate").lower()
+MIN_SAMPLE_PERCENT = float(os.getenv("BQ_MIN_SAMPLE_PERCENT", "1"))
+
+# Error messages for over-budget queries start with this, so callers can tell them apart.
+OVER_BUDGET_PREFIX = "Query over budget:"
+
+
+class Decision:
+    """Outcome of the cost policy for one query.
+
+    `action` is "run", "sample", "reject" or "regenerate". `max_bytes_billed` is the
+    hard cap to set on the query job (None when no budget applies).
+    """
+
+    def __init__(self, action, max_bytes_billed=None, sample_percent=None, message=""):
+        self.action = action
+        self.max_bytes_billed = max_bytes_billed
+        self.sample_percent = sample_percent
+        self.message = message
+
+
+class CostLedger:
+    """Bytes billed per user and for the whole deployment in the current UTC day,
+    plus the recent dry-run estimates next to what was actually billed."""
+
+    def __init__(self, max_records=1000):
+        self._day = None
+        self._by_user = {}
+        self._total = 0
+        self._records = deque(maxlen=max_records)  # (user_id, estimate, billed, sampled)
+        self._lock = threading.Lock()
+
+    def _roll_day(self):
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        if today != self._day:
+            self._day, self._by_user, self._total = today, {}, 0
+
+    def spent(self, user_id):
+        """Returns (bytes billed to the user today, bytes billed to the deployment today)."""
+        with self._lock:
+            self._roll_day()
+            return self._by_user.get(user_id, 0), self._total
+
+    def record(self, user_id, estimate, billed, sampled=False):
+        with self._lock:
+            self._roll_day()
+            self._by_user[user_id] = self._by_user.get(user_id, 0) + billed
+            self._total += billed
+            self._records.append((user_id, estimate, billed, sampled))
+        logger.info(
+            "BigQuery cost: user=%s estimated=%s billed=%s sampled=%s", user_id, estimate, billed, sampled
+        )
+
+    def stats(self):
+        """Returns totals over the recorded queries and the billed/estimated ratio."""
+        with self._lock:
+            records = [r for r in self._records if r[1] is not None]
+        estimated = sum(r[1] for r in records)
+        billed = sum(r[2] for r in records)
+        return {
+            "queries": len(records),
+            "estimated_bytes": estimated,
+            "billed_bytes": billed,
+            "billed_to_estimated": billed / estimated if estimated else None,
+            "sampled_queries": sum(1 for r in records if r[3]),
+        }
+
+
+ledger = CostLedger()
+
+
+def remaining_bytes(user_id):
+    """Returns the bytes a single query of the user may bill, or None if no budget is set."""
+    user_spent, total_spent = ledger.spent(user_id)
+    limits = [
+        limit
+        for limit, budget in (
+            (MAX_BYTES_PER_QUERY, MAX_BYTES_PER_QUERY),
+            (USER_DAILY_BYTES - user_spent, USER_DAILY_BYTES),
+            (DEPLOYMENT_DAILY_BYTES - total_spent, DEPLOYMENT_DAILY_BYTES),
+        )
+        if budget > 0
+    ]
+    return max(min(limits), 0) if limits else None
+
+
+def evaluate(estimate, user_id):
+    """Applies the budgets to a dry-run estimate (`total_bytes_processed`) and returns a Decision."""
+    allowed = remaining_bytes(user_id)
+    if allowed is None or estimate is None or estimate <= allowed:
+        return Decision("run", max_bytes_billed=allowed)
+
+    if allowed == 0:
+        # Nothing a tighter query can fix once a daily budget is used up.
+        return Decision("reject", max_bytes_billed=0, message=(
+            "Query budget used up: the daily BigQuery byte budget has been spent. Try again tomorrow."
+        ))
+    message = (
+        f"{OVER_BUDGET_PREFIX} the query would scan {format_bytes(estimate)} "
+        f"but only {format_bytes(allowed)} is allowed."
+    )
+    if OVER_BUDGET_ACTION == "sample":
+        # Scanned bytes scale with the sampled fraction; leave headroom for small tables
+        # that TABLESAMPLE reads whole.
+        percent = int(90 * allowed / estimate * 10) / 10
+        if percent >= MIN_SAMPLE_PERCENT:
+            return Decision("sample", max_bytes_billed=allowed, sample_percent=percent, message=message)
+    action = "reject" if OVER_BUDGET_ACTION == "reject" else "regenerate"
+    return Decision(action, max_bytes_billed=allowed, message=message)
@@ -0,0 +1,110 @@
+import contextlib
+import contextvars
+import os
+import time
+
+# Wall-clock budget for answering one question, in seconds; 0 disables it.
+QUESTION_DEADLINE_SECONDS = float(os.getenv("QUESTION_DEADLINE_SECONDS", "180"))
+
+# The most of the question budget a single stage may use. A stage always gets at
+# most what is left, so the shares need not add up to 1: a fast schema load leaves
+# more time for generation and execution.
+STAGE_SHARES = {
+    "schema": 0.2,
+    "generation": 0.4,
+    "correction": 0.3,
+    "dry_run": 0.1,
+    "execution": 0.6,
+}
+
+_current = contextvars.ContextVar("question_deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """The question deadline ran out before a stage could start."""
+
+    def __init__(self, stage, seconds):
+        super().__init__(f"question deadline of {seconds:g}s exceeded at the {stage} stage")
+        self.stage = stage
+
+
+class Deadline:
+    """A per-question time budget shared by the pipeline stages."""
+
+    def __init__(self, seconds, invocation_id=None):
+        self.seconds = seconds
+        self.invocation_id = invocation_id
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def stage_timeout(self, stage):
+        """Seconds `stage` may take: its share of the budget, capped by what is left."""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(stage, self.seconds)
+        return min(remaining, self.seconds * STAGE_SHARES.get(stage, 1.0))
+
+
+def current():
+    """Returns the Deadline of the question being answered, or None."""
+    return _current.get()
+
+
+def start(seconds=None, invocation_id=None):
+    """Starts a new deadline in the current context and returns it (None when disabled)."""
+    seconds = QUESTION_DEADLINE_SECONDS if seconds is None else seconds
+    deadline = Deadline(seconds, invocation_id) if seconds > 0 else None
+    _current.set(deadline)
+    return deadline
+
+
+@contextlib.contextmanager
+def budget(seconds=None):
+    """Runs the block under a fresh question deadline."""
+    token = _current.set(None)
+    try:
+        yield start(seconds)
+    finally:
+        _current.reset(token)
+
+
+def ensure(invocation_id, seconds=None):
+    """Starts the deadline of an agent invocation unless one is already running.
+
+    A deadline set by the caller (e.g. main.py's budget) is kept; one left over
+    from an earlier invocation is replaced.
+    """
+    deadline = current()
+    if deadline is not None and deadline.invocation_id in (None, invocation_id):
+        return deadline
+    return start(seconds, invocation_id)
+
+
+def remaining():
+    """Seconds left for the current question, or None if it has no deadline."""
+    deadline = current()
+    return deadline.remaining() if deadline is not None else None
+
+
+def expired():
+    deadline = current()
+    return deadline is not None and deadline.expired()
+
+
+def stage_timeout(stage, default=None):
+    """Timeout for `stage` under the current deadline, capped at `default`.
+
+    Returns `default` when there is no deadline and raises DeadlineExceeded when
+    it has already run out. Worker threads see the deadline when they are started
+    with asyncio.to_thread or contextvars.copy_context().run.
+    """
+    deadline = current()
+    if deadline is None:
+        return default
+    timeout = deadline.stage_timeout(stage)
+    return timeout if default is None else min(timeout, default)
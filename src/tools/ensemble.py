@@ -0,0 +1,167 @@
+import contextvars
+import datetime
+import decimal
+import hashlib
+import logging
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import sqlglot
+from tools import cost_policy
+from tools import deadline
+from tools import rewriter
+from tools.bigquery_io import billed_bytes, execute_query
+from tools.schema import get_table_partitioning
+
+logger = logging.getLogger(__name__)
+
+# Candidates are compared on a probe run: at most ENSEMBLE_PROBE_ROWS rows, the
+# BQ_DEFAULT_DAYS partition filter on partitioned tables, and a hard byte cap per probe.
+# Probes that come back empty or truncated at the row cap don't vote: empty results
+# all look alike, and without an ORDER BY a truncated one is an arbitrary subset.
+ENSEMBLE_PROBE_ROWS = int(os.getenv("ENSEMBLE_PROBE_ROWS", "1000"))
+ENSEMBLE_PROBE_MAX_BYTES = int(os.getenv("ENSEMBLE_PROBE_MAX_BYTES", str(2 * 2**30)))
+
+# Process-wide counters: `questions`, `candidates`, `distinct_candidates`, `probes`,
+# `probe_failures`, `empty_probes`, `truncated_probes`, `over_budget`,
+# `probe_bytes_billed`, `probe_seconds`, `unanimous` and `split`.
+ENSEMBLE_STATS = Counter()
+
+
+def get_ensemble_stats():
+    """Returns a snapshot of the ensemble counters."""
+    return dict(ENSEMBLE_STATS)
+
+
+def normalize(sql):
+    """Returns the query in a canonical formatting, so equivalent spellings compare equal."""
+    try:
+        return rewriter.parse(sql).sql("bigquery")
+    except sqlglot.errors.SqlglotError:
+        return " ".join(sql.split())
+
+
+def distinct_candidates(candidates):
+    """Drops candidates that normalize to an earlier one, keeping the order."""
+    seen, distinct = set(), []
+    for sql in candidates:
+        key = normalize(sql)
+        if key not in seen:
+            seen.add(key)
+            distinct.append(sql)
+    return distinct
+
+
+def _normalize_value(value):
+    if isinstance(value, (float, decimal.Decimal)):
+        return f"{float(value):.6g}"
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return repr(value)
+
+
+def fingerprint(rows):
+    """Hashes a result set independently of column names, column order and row order."""
+    canonical = sorted(tuple(sorted(_normalize_value(value) for value in row.values())) for row in rows)
+    return hashlib.sha1(repr(canonical).encode()).hexdigest()
+
+
+def probe_sql(sql):
+    """Returns the query as it is run for the vote: partition-filtered and capped at one
+    row more than ENSEMBLE_PROBE_ROWS, so truncated results can be told apart."""
+    data_project, dataset = os.getenv("BQ_DATA_PROJECT_ID"), os.getenv("BQ_DATASET_ID")
+    table_ids = rewriter.referenced_table_ids(rewriter.parse(sql), data_project, dataset)
+    partitioning = get_table_partitioning(table_ids, compute_project_id=os.getenv("BQ_COMPUTE_PROJECT_ID"))
+    probe, _ = rewriter.rewrite_for_execution(
+        sql,
+        partitioning,
+        max_limit=ENSEMBLE_PROBE_ROWS + 1,
+        default_days=int(os.getenv("BQ_DEFAULT_DAYS", "30")),
+        default_project=data_project,
+        default_dataset=dataset,
+    )
+    return probe
+
+
+def _run_probe(sql, user_id, max_bytes_billed=ENSEMBLE_PROBE_MAX_BYTES):
+    """Runs a candidate's probe and returns its rows as dicts."""
+    jobs = []
+    try:
+        results = execute_query(
+            probe_sql(sql), max_bytes_billed, jobs, timeout=deadline.stage_timeout("execution")
+        )
+        return [dict(row.items()) for row in results]
+    finally:
+        billed = sum(billed_bytes(job) for job in jobs)
+        ENSEMBLE_STATS["probe_bytes_billed"] += billed
+        cost_policy.ledger.record(user_id, None, billed)
+
+
+def vote(candidates, user_id="default", run_probe=None):
+    """Picks the candidate whose probe result most candidates agree on.
+
+    `candidates` are SQL strings in order of preference; ties and the case where
+    no probe yields a comparable result go to the first one. Distinct candidates
+    are probed concurrently with `run_probe(sql, user_id, max_bytes_billed)`,
+    which returns rows as dicts; the user's remaining byte budget is split
+    between the probes, and none run once it is spent.
+    Returns (sql, {fingerprint: votes}).
+    """
+    run_probe = run_probe or _run_probe
+    ENSEMBLE_STATS["questions"] += 1
+    ENSEMBLE_STATS["candidates"] += len(candidates)
+    distinct = distinct_candidates(candidates)
+    ENSEMBLE_STATS["distinct_candidates"] += len(distinct)
+    if len(distinct) == 1:
+        ENSEMBLE_STATS["unanimous"] += 1
+        return distinct[0], {}
+
+    max_bytes_billed = ENSEMBLE_PROBE_MAX_BYTES
+    allowed = cost_policy.remaining_bytes(user_id)
+    if allowed is not None:
+        max_bytes_billed = min(max_bytes_billed, allowed // len(distinct))
+        if max_bytes_billed <= 0:
+            ENSEMBLE_STATS["over_budget"] += 1
+            logger.info("Ensemble probes skipped: the byte budget is spent")
+            return distinct[0], {}
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=len(distinct)) as executor:
+        # Copy the context so the probes see the question deadline.
+        futures = [
+            executor.submit(contextvars.copy_context().run, run_probe, sql, user_id, max_bytes_billed)
+            for sql in distinct
+        ]
+    ENSEMBLE_STATS["probe_seconds"] += time.monotonic() - start
+    ENSEMBLE_STATS["probes"] += len(distinct)
+
+    fingerprints = {}  # Index into distinct -> fingerprint.
+    for index, future in enumerate(futures):
+        try:
+            rows = future.result()
+        except Exception as e:
+            ENSEMBLE_STATS["probe_failures"] += 1
+            logger.info("Ensemble probe of candidate %d failed: %s", index, e)
+            continue
+        if not rows:
+            ENSEMBLE_STATS["empty_probes"] += 1
+        elif len(rows) > ENSEMBLE_PROBE_ROWS:
+            ENSEMBLE_STATS["truncated_probes"] += 1
+        else:
+            fingerprints[index] = fingerprint(rows)
+
+    # Duplicates of a candidate vote for its result too.
+    normalized = [normalize(sql) for sql in distinct]
+    tally = Counter()
+    for sql in candidates:
+        index = normalized.index(normalize(sql))
+        if index in fingerprints:
+            tally[fingerprints[index]] += 1
+    if not tally:
+        return distinct[0], {}
+    winner, _ = max(tally.items(), key=lambda item: item[1])  # First maximum wins ties.
+    ENSEMBLE_STATS["unanimous" if len(tally) == 1 else "split"] += 1
+    chosen = next(index for index in sorted(fingerprints) if fingerprints[index] == winner)
+    logger.info("Ensemble vote %s: picked candidate %d of %d", dict(tally), chosen, len(distinct))
+    return distinct[chosen], dict(tally)
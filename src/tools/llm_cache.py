@@ -0,0 +1,142 @@
+import contextlib
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# "off" (the default) disables the cache, "readwrite" serves repeated deterministic
+# prompts from it, "record" calls the model every time and stores the responses, and
+# "replay" only reads the cache (a miss raises CacheMiss), e.g. for offline benchmark runs.
+LLM_CACHE_MODE = os.getenv("LLM_CACHE_MODE", "off").lower()
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH") or os.path.join(tempfile.gettempdir(), "nl2sql_llm_cache.sqlite")
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_MB", "256")) * 2**20
+
+# Process-wide counters: `hits`, `misses`, `writes` and `evictions`.
+CACHE_STATS = Counter()
+
+_bypass = contextvars.ContextVar("llm_cache_bypass", default=False)
+
+
+class CacheMiss(LookupError):
+    """No cached response for a prompt in replay mode."""
+
+
+def cache_key(model, config, prompt):
+    """Hash of everything that determines the response: model, generation config and prompt."""
+    payload = json.dumps([model, config, prompt], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResponseCache:
+    """LLM responses in a SQLite file, evicting the least recently used beyond `max_bytes`."""
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._ready = False
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        if not self._ready:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, created REAL, accessed REAL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self._ready = True
+        return connection
+
+    def get(self, key):
+        with self._lock, contextlib.closing(self._connect()) as connection, connection:
+            row = connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+        return row[0] if row is not None else None
+
+    def put(self, key, model, response):
+        now = time.time()
+        with self._lock, contextlib.closing(self._connect()) as connection, connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, response, len(response.encode()), now, now),
+            )
+            total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                self._evict(connection, total - int(self.max_bytes * 0.9))
+
+    def _evict(self, connection, excess):
+        # Down to 90% of the budget, so the next few writes don't evict again.
+        evicted = 0
+        for key, size in connection.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+            if excess <= 0:
+                break
+            connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            excess -= size
+            evicted += 1
+        CACHE_STATS["evictions"] += evicted
+
+    def stats(self):
+        with self._lock, contextlib.closing(self._connect()) as connection:
+            entries, size = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {**CACHE_STATS, "entries": entries, "bytes": size}
+
+
+cache = ResponseCache(LLM_CACHE_PATH, LLM_CACHE_MAX_BYTES)
+
+
+@contextlib.contextmanager
+def bypass():
+    """Calls the model directly inside the block, without reading or writing the cache."""
+    token = _bypass.set(True)
+    try:
+        yield
+    finally:
+        _bypass.reset(token)
+
+
+def cached_call(model, config, prompt, call, deterministic=True):
+    """Returns call()'s response text for the prompt, going through the cache per LLM_CACHE_MODE.
+
+    In readwrite mode only `deterministic` calls are cached: sampling several
+    candidates from the same prompt must still return different responses.
+    Cache errors are logged and the model is called instead.
+    """
+    mode = "off" if _bypass.get() else LLM_CACHE_MODE
+    if mode == "off" or (mode == "readwrite" and not deterministic):
+        return call()
+    key = cache_key(model, config, prompt)
+    if mode != "record":
+        try:
+            response = cache.get(key)
+        except sqlite3.Error as e:
+            logger.warning("LLM cache read failed: %s", e)
+            response = None
+        if response is not None:
+            CACHE_STATS["hits"] += 1
+            return response
+        CACHE_STATS["misses"] += 1
+        if mode == "replay":
+            raise CacheMiss(f"No recorded response of {model} for this prompt (LLM_CACHE_MODE=replay).")
+    response = call()
+    if isinstance(response, str):
+        try:
+            cache.put(key, model, response)
+            CACHE_STATS["writes"] += 1
+        except sqlite3.Error as e:
+            logger.warning("LLM cache write failed: %s", e)
+    return response
+
+
+def get_cache_stats():
+    """Returns the cache counters with the current number of entries and bytes on disk."""
+    return cache.stats()
@@ -1 +1,61 @@
-# This file will call ADK initial_bq_nl2sql()
\ No newline at end of file
+from tools import llm_cache
+from tools.prompts import BASELINE_NL2SQL_PROMPT, SQL_REPAIR_PROMPT
+
+
+def extract_sql(text):
+    """Strips markdown code fences from a model response."""
+    if not text:
+        return text
+    return text.replace("```sql", "").replace("```", "").strip()
+
+
+def _request_options(timeout):
+    return {"timeout": timeout} if timeout is not None else None
+
+
+# Generation runs greedy, so a cached response is the one the model would give again.
+GENERATION_CONFIG = {"temperature": 0.0}
+
+
+def _generate(model, prompt, timeout, usage=None, generation_config=None):
+    """Returns the model's response text; at temperature 0 it may come from the LLM response cache."""
+
+    def call():
+        response = model.generate_content(
+            contents=prompt, generation_config=generation_config, request_options=_request_options(timeout)
+        )
+        if usage is not None:
+            usage.append(getattr(response, "usage_metadata", None))
+        return response.text
+
+    return llm_cache.cached_call(
+        getattr(model, "model_name", repr(model)),
+        generation_config,
+        prompt,
+        call,
+        deterministic=(generation_config or {}).get("temperature") == 0,
+    )
+
+
+def generate_sql(model, question, schema, max_rows, timeout=None, usage=None):
+    """Generates a SQL query for the question with the given generative model.
+
+    `timeout` bounds the model request in seconds. The response's usage_metadata
+    is appended to `usage` if given (not on cache hits, which cost nothing).
+    """
+    prompt = BASELINE_NL2SQL_PROMPT.format(
+        MAX_NUM_ROWS=max_rows, SCHEMA=schema, QUESTION=question
+    )
+    return extract_sql(_generate(model, prompt, timeout, usage, GENERATION_CONFIG))
+
+
+def repair_sql(model, question, schema, sql, error, max_rows, timeout=None):
+    """Asks the generative model to fix a SQL query given the BigQuery error.
+
+    Repairs sample at the model's default temperature, so a repair loop can try
+    something new each round; they are only cached in record/replay mode.
+    """
+    prompt = SQL_REPAIR_PROMPT.format(
+        MAX_NUM_ROWS=max_rows, SCHEMA=schema, QUESTION=question, SQL=sql, ERROR=error
+    )
+    return extract_sql(_generate(model, prompt, timeout))
@@ -1 +1,51 @@
-# This file will handle system/user prompt construction.
\ No newline at end of file
+BASELINE_NL2SQL_PROMPT = """You are a BigQuery SQL expert.
+Given a question and a database schema, your task is to generate a SQL query that answers the question.
+
+###
+DATABASE SCHEMA:
+{SCHEMA}
+###
+
+QUESTION:
+{QUESTION}
+
+###
+INSTRUCTIONS:
+- The SQL query should be written for BigQuery.
+- The query should be correct and executable.
+- The query should be as simple as possible.
+- The query should return a maximum of {MAX_NUM_ROWS} rows.
+- Filter on the PARTITION BY and CLUSTER BY columns of a table whenever the question allows it; a table with `require_partition_filter=TRUE` must have a filter on its partition column.
+- When several tables can answer the question, prefer the smallest one (row counts and sizes are in the comment after each table).
+- Do not add any comments to the query.
+- Do not add any text before or after the query.
+- The query should be written in a single line.
+"""
+
+SQL_REPAIR_PROMPT = """You are a BigQuery SQL expert.
+A SQL query was generated to answer the question below, but BigQuery rejected it. Fix the query.
+
+###
+DATABASE SCHEMA:
+{SCHEMA}
+###
+
+QUESTION:
+{QUESTION}
+
+###
+FAILED SQL:
+{SQL}
+
+BIGQUERY ERROR:
+{ERROR}
+
+###
+INSTRUCTIONS:
+- Fix the cause of the error and keep the rest of the query unchanged.
+- Only use tables and columns from the database schema.
+- The query should return a maximum of {MAX_NUM_ROWS} rows.
+- Do not add any comments to the query.
+- Do not add any text before or after the query.
+- The query should be written in a single line.
+"""
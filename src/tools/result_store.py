@@ -0,0 +1,166 @@
+import os
+import secrets
+import tempfile
+import threading
+from collections import OrderedDict
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+
+# Bucket units accepted by aggregate() in "column:unit" group-by keys.
+TIME_BUCKET_FORMATS = {"day": "%Y-%m-%d", "month": "%Y-%m", "year": "%Y"}
+
+AGGREGATE_FUNCTIONS = {"sum", "mean", "min", "max", "count", "count_distinct"}
+
+FILTER_OPERATORS = {
+    "=": pc.equal,
+    "!=": pc.not_equal,
+    ">": pc.greater,
+    ">=": pc.greater_equal,
+    "<": pc.less,
+    "<=": pc.less_equal,
+}
+
+
+def to_arrow(results):
+    """Converts BigQuery results (a RowIterator or a list of dict-like rows) to an Arrow table."""
+    if hasattr(results, "to_arrow"):
+        return results.to_arrow()
+    return pa.Table.from_pylist([dict(row.items()) for row in results])
+
+
+class ResultStore:
+    """Keeps query results as Arrow tables under short random handles.
+
+    Each result belongs to the owner it was stored for, and get() only returns it
+    to that owner, so handles cannot be used to read other users' results.
+    Tables live in memory until the store exceeds its memory budget; the least
+    recently used ones are then written to Feather files and memory-mapped back
+    on access. The oldest results are dropped once `max_results` is exceeded.
+    """
+
+    def __init__(self, memory_budget_bytes, spill_dir=None, max_results=100):
+        self.memory_budget_bytes = memory_budget_bytes
+        self.max_results = max_results
+        self._spill_dir = spill_dir
+        self._in_memory = OrderedDict()  # handle -> pa.Table
+        self._spilled = OrderedDict()  # handle -> Feather path
+        self._owners = {}  # handle -> owner
+        self._lock = threading.Lock()
+
+    def _spill_path(self, handle):
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix="result_store_")
+        return os.path.join(self._spill_dir, f"{handle}.arrow")
+
+    def _memory_bytes(self):
+        return sum(table.nbytes for table in self._in_memory.values())
+
+    def _enforce_limits(self):
+        while len(self._in_memory) > 1 and self._memory_bytes() > self.memory_budget_bytes:
+            handle, table = self._in_memory.popitem(last=False)
+            path = self._spill_path(handle)
+            feather.write_feather(table, path)
+            self._spilled[handle] = path
+        while len(self._in_memory) + len(self._spilled) > self.max_results:
+            if self._spilled:
+                handle, path = self._spilled.popitem(last=False)
+                os.remove(path)
+            else:
+                handle, _ = self._in_memory.popitem(last=False)
+            self._owners.pop(handle, None)
+
+    def put(self, table, handle=None, owner=None):
+        """Stores a table for `owner` and returns its handle. Passing an existing handle replaces that result."""
+        with self._lock:
+            if handle is None:
+                handle = f"r{secrets.token_hex(4)}"
+                while handle in self._owners:
+                    handle = f"r{secrets.token_hex(4)}"
+            # A replaced result keeps its owner.
+            self._owners.setdefault(handle, owner)
+            path = self._spilled.pop(handle, None)
+            if path:
+                os.remove(path)
+            self._in_memory[handle] = table
+            self._in_memory.move_to_end(handle)
+            self._enforce_limits()
+            return handle
+
+    def owns(self, handle, owner):
+        """True if the handle holds a result stored for `owner`."""
+        with self._lock:
+            return handle in self._owners and self._owners[handle] == owner
+
+    def get(self, handle, owner=None):
+        """Returns the owner's table stored under the handle.
+
+        Raises KeyError for unknown handles and for those of other owners alike.
+        """
+        with self._lock:
+            if handle in self._owners and self._owners[handle] == owner:
+                if handle in self._in_memory:
+                    self._in_memory.move_to_end(handle)
+                    return self._in_memory[handle]
+                if handle in self._spilled:
+                    return feather.read_table(self._spilled[handle], memory_map=True)
+        raise KeyError(f"Unknown result handle '{handle}'.")
+
+
+def page(table, offset=0, limit=50):
+    return table.slice(offset, limit)
+
+
+def sort(table, column, descending=False):
+    return table.sort_by([(column, "descending" if descending else "ascending")])
+
+
+def filter_rows(table, column, operator, value):
+    """Filters rows with `column <operator> value`; also supports `contains` and `in` (comma-separated)."""
+    column_type = table.schema.field(column).type
+    values = table[column]
+    if operator == "contains":
+        return table.filter(pc.match_substring(values, value, ignore_case=True))
+    if operator == "in":
+        options = pa.array([v.strip() for v in value.split(",")]).cast(column_type)
+        return table.filter(pc.is_in(values, value_set=options))
+    if operator not in FILTER_OPERATORS:
+        raise ValueError(f"Unsupported operator '{operator}'. Use one of {sorted(FILTER_OPERATORS)}, contains, in.")
+    return table.filter(FILTER_OPERATORS[operator](values, pa.scalar(value).cast(column_type)))
+
+
+def _bucket(table, key):
+    """Resolves a group-by key, adding a bucketed column for "column:unit" keys."""
+    column, _, unit = key.partition(":")
+    if not unit:
+        return table, column
+    if unit not in TIME_BUCKET_FORMATS:
+        raise ValueError(f"Unsupported time bucket '{unit}'. Use one of {sorted(TIME_BUCKET_FORMATS)}.")
+    values = table[column]
+    if not pa.types.is_timestamp(values.type):
+        values = pc.cast(values, pa.timestamp("s"))
+    name = f"{column}_{unit}"
+    return table.append_column(name, pc.strftime(values, format=TIME_BUCKET_FORMATS[unit])), name
+
+
+def aggregate(table, group_by, column, function):
+    """Groups by the given keys (e.g. ["constraintName", "operatingDate:month"]) and aggregates one column."""
+    if function not in AGGREGATE_FUNCTIONS:
+        raise ValueError(f"Unsupported function '{function}'. Use one of {sorted(AGGREGATE_FUNCTIONS)}.")
+    keys = []
+    for key in group_by:
+        table, name = _bucket(table, key)
+        keys.append(name)
+    result = table.group_by(keys).aggregate([(column, function)])
+    return result.sort_by([(key, "ascending") for key in keys])
+
+
+def numeric_stats(table):
+    """Returns {column: (count, min, max, mean)} for the numeric columns, computed with Arrow kernels."""
+    stats = {}
+    for name, values in zip(table.column_names, table.columns):
+        if not (pa.types.is_integer(values.type) or pa.types.is_floating(values.type) or pa.types.is_decimal(values.type)):
+            continue
+        min_max = pc.min_max(values).as_py()
+        stats[name] = (pc.count(values).as_py(), min_max["min"], min_max["max"], pc.mean(values).as_py())
+    return stats
@@ -0,0 +1,363 @@
+import re
+import sqlglot
+from sqlglot import exp
+from sqlglot.optimizer.pushdown_projections import pushdown_projections
+from sqlglot.optimizer.qualify import qualify
+
+# Lower bound of an injected partition filter, per partition column type.
+_RECENT_BOUND = {
+    "DATE": "DATE_SUB(CURRENT_DATE(), INTERVAL {days} DAY)",
+    "DATETIME": "DATETIME_SUB(CURRENT_DATETIME(), INTERVAL {days} DAY)",
+    "TIMESTAMP": "TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {days} DAY)",
+}
+
+
+def parse(sql):
+    return sqlglot.parse_one(sql, read="bigquery")
+
+
+def table_id(table, default_project=None, default_dataset=None):
+    """Returns the `project.dataset.table` id of a table reference, filling in defaults."""
+    return ".".join(
+        part for part in (table.catalog or default_project, table.db or default_dataset, table.name) if part
+    )
+
+
+def referenced_table_ids(ast, default_project=None, default_dataset=None):
+    """Returns the ids of the physical tables read by the query (CTE names excluded)."""
+    cte_names = {cte.alias_or_name for cte in ast.find_all(exp.CTE)}
+    return sorted({
+        table_id(table, default_project, default_dataset)
+        for table in ast.find_all(exp.Table)
+        if table.name not in cte_names or table.db
+    })
+
+
+def _references_column(condition, column, alias):
+    if condition is None:
+        return False
+    return any(
+        c.name.lower() == column.lower() and (not c.table or c.table == alias)
+        for c in condition.find_all(exp.Column)
+    )
+
+
+def enforce_limit(ast, max_limit):
+    """Adds `LIMIT max_limit` to the outermost query, or lowers a larger LIMIT. Returns the change, if any."""
+    limit = ast.args.get("limit")
+    if limit is None:
+        ast.set("limit", exp.Limit(expression=exp.Literal.number(max_limit)))
+        return f"added LIMIT {max_limit}"
+    value = limit.expression
+    if isinstance(value, exp.Literal) and not value.is_string and int(value.this) > max_limit:
+        limit.set("expression", exp.Literal.number(max_limit))
+        return f"lowered LIMIT {value.this} to {max_limit}"
+    return None
+
+
+def _conditions(select):
+    return [select.args.get("where")] + [j.args.get("on") for j in select.args.get("joins") or []]
+
+
+def _filters(select, names, alias):
+    """True if the select's WHERE or ON conditions reference one of the column names of `alias`."""
+    return any(_references_column(c, name, alias) for c in _conditions(select) for name in names)
+
+
+def _exposed_names(select, names, alias):
+    """Returns the output names under which the select passes on the columns `names` of `alias`."""
+    exposed = set()
+    for projection in select.expressions:
+        inner = projection.unalias()
+        if isinstance(inner, exp.Star) or (isinstance(inner, exp.Column) and isinstance(inner.this, exp.Star)
+                                           and inner.table in ("", alias)):
+            exposed |= names
+        elif isinstance(inner, exp.Column) and inner.table in ("", alias) and inner.name.lower() in {
+            name.lower() for name in names
+        }:
+            exposed.add(projection.alias_or_name)
+    return exposed
+
+
+def _filtered_outside(ast, select, names):
+    """True if a scope reading the select's output filters on `names`, its output columns that
+    carry the partition column (directly or through further derived tables and CTEs). One
+    filtering reader is enough: a filter injected below it would change its result."""
+    if not names:
+        return False
+    parent = select.parent
+    if isinstance(parent, exp.Subquery) and isinstance(parent.parent, (exp.From, exp.Join)):
+        readers = [(parent.alias_or_name, parent.parent.parent)]
+    elif isinstance(parent, exp.CTE):
+        readers = [
+            (table.alias_or_name, table.parent.parent)
+            for table in ast.find_all(exp.Table)
+            if table.name == parent.alias_or_name and not table.db and isinstance(table.parent, (exp.From, exp.Join))
+        ]
+    else:
+        return False
+    return any(
+        isinstance(outer, exp.Select)
+        and (_filters(outer, names, alias) or _filtered_outside(ast, outer, _exposed_names(outer, names, alias)))
+        for alias, outer in readers
+    )
+
+
+def enforce_partition_filters(ast, partitioning, default_days, default_project=None, default_dataset=None):
+    """Adds a recent-days filter on the partition column of every partitioned table read without one.
+
+    The filter goes into the WHERE clause for the FROM table and into the ON clause for
+    joined tables, so outer joins keep their semantics. No filter is added when the
+    partition column is already filtered: in the same scope (also on another alias of
+    the same table, as in a self-join), or in the scopes reading a CTE or derived table,
+    also through the alias it is projected under. Returns the list of changes.
+    """
+    changes = []
+    for table in list(ast.find_all(exp.Table)):
+        info = partitioning.get(table_id(table, default_project, default_dataset))
+        if not info or not isinstance(table.parent, (exp.From, exp.Join)):
+            continue
+        select = table.parent if isinstance(table.parent, exp.Join) else table.parent.parent
+        if isinstance(select, exp.Join):
+            select = select.parent
+        if not isinstance(select, exp.Select):
+            continue
+
+        alias = table.alias_or_name
+        field = info["field"]
+        same_table = {
+            other.alias_or_name for other in select.find_all(exp.Table)
+            if other.parent_select is select
+            and table_id(other, default_project, default_dataset) == table_id(table, default_project, default_dataset)
+        }
+        if any(_filters(select, {field}, other) for other in same_table | {alias}):
+            continue
+        if _filtered_outside(ast, select, _exposed_names(select, {field}, alias)):
+            continue
+
+        bound = _RECENT_BOUND.get(info["field_type"], _RECENT_BOUND["DATE"]).format(days=default_days)
+        predicate = exp.GTE(this=exp.column(field, table=alias), expression=parse(bound))
+        if isinstance(table.parent, exp.Join):
+            join = table.parent
+            on = join.args.get("on")
+            join.set("on", exp.and_(on, predicate) if on is not None else predicate)
+        else:
+            select.where(predicate, copy=False)
+        changes.append(f"added partition filter {predicate.sql('bigquery')} on {table.name}")
+    return changes
+
+
+def rewrite_for_execution(sql, partitioning, max_limit, default_days, default_project=None, default_dataset=None):
+    """Enforces LIMIT and partition filters. Returns (sql, changes); the SQL is unchanged if changes is empty."""
+    ast = parse(sql)
+    changes = enforce_partition_filters(ast, partitioning, default_days, default_project, default_dataset)
+    limit_change = enforce_limit(ast, max_limit)
+    if limit_change:
+        changes.append(limit_change)
+    if not changes:
+        return sql, []
+    return ast.sql("bigquery"), changes
+
+
+def add_tablesample(sql, percent, table_sizes, default_project=None, default_dataset=None):
+    """Adds `TABLESAMPLE SYSTEM (percent PERCENT)` to the largest table read by the query.
+
+    Only one table is sampled so that joins keep matching rows. `table_sizes` maps
+    table ids to bytes. Returns (sql, sampled table id), or (sql, None) if no table qualifies.
+    """
+    ast = parse(sql)
+    candidates = [
+        table for table in ast.find_all(exp.Table)
+        if isinstance(table.parent, (exp.From, exp.Join)) and not table.args.get("sample")
+        and table_id(table, default_project, default_dataset) in table_sizes
+    ]
+    if not candidates:
+        return sql, None
+    largest = max(candidates, key=lambda t: table_sizes[table_id(t, default_project, default_dataset)] or 0)
+    largest.set("sample", exp.TableSample(method=exp.var("SYSTEM"), percent=exp.Literal.number(percent)))
+    return ast.sql("bigquery"), table_id(largest, default_project, default_dataset)
+
+
+def _projection_count(ast):
+    return sum(len(select.expressions) for select in ast.find_all(exp.Select))
+
+
+def _restore_case(ast, names):
+    """Restores the original spelling of identifiers that qualify() lowercased.
+
+    BigQuery column names and aliases are case-insensitive, but table names and
+    the names of the result columns are not.
+    """
+    for identifier in ast.find_all(exp.Identifier):
+        original = names.get(identifier.name.lower())
+        if original:
+            identifier.set("this", original)
+    return ast
+
+
+def prune_columns(sql, schema, default_project=None, default_dataset=None, wide_columns=20):
+    """Expands `*` and drops columns that CTEs and subqueries select but nothing downstream uses.
+
+    `schema` maps project -> dataset -> table -> {column: type}. Returns
+    (sql, changes, warnings); the SQL is unchanged if changes is empty. Raises
+    sqlglot errors if the query cannot be qualified against the schema.
+    """
+    ast = parse(sql)
+    names = {}
+    for project, datasets in schema.items():
+        for dataset, tables in datasets.items():
+            for table, columns in tables.items():
+                for name in (project, dataset, table, *columns):
+                    names.setdefault(name.lower(), name)
+    # Spellings used in the query win, so the result columns keep their names.
+    names.update({identifier.name.lower(): identifier.name for identifier in ast.find_all(exp.Identifier)})
+
+    # Fully qualify table names first: qualify() lowercases unqualified ones.
+    cte_names = {cte.alias_or_name for cte in ast.find_all(exp.CTE)}
+    for table in ast.find_all(exp.Table):
+        if table.name in cte_names and not table.db:
+            continue
+        if not table.db and default_dataset:
+            table.set("db", exp.to_identifier(default_dataset))
+        if not table.catalog and default_project:
+            table.set("catalog", exp.to_identifier(default_project))
+
+    first_select = ast if isinstance(ast, exp.Select) else ast.find(exp.Select)
+    ast_outer_star = first_select is not None and any(isinstance(e, exp.Star) for e in first_select.expressions)
+    stars = len([star for star in ast.find_all(exp.Star) if not isinstance(star.parent, exp.Count)])
+    qualified = qualify(ast, schema=schema, dialect="bigquery")
+    expanded_count = _projection_count(qualified)
+    pruned = pushdown_projections(qualified)
+    removed = expanded_count - _projection_count(pruned)
+
+    warnings = []
+    outer = pruned if isinstance(pruned, exp.Select) else pruned.find(exp.Select)
+    if outer is not None:
+        # qualify() names unaliased expressions _col_N; BigQuery would call them f0_, f1_, ...
+        # It also rewrites ORDER BY 2 and the like to these aliases, so referenced ones stay.
+        referenced = {
+            column.name for column in outer.find_all(exp.Column)
+            if not column.table and column.parent_select is outer
+        }
+        for projection in outer.expressions:
+            if (isinstance(projection, exp.Alias) and re.fullmatch(r"_col_\d+", projection.alias)
+                    and projection.alias not in referenced):
+                projection.replace(projection.this)
+    if ast_outer_star:
+        warnings.append("SELECT * in the outer query reads every column of the table")
+    if outer is not None and len(outer.expressions) > wide_columns:
+        warnings.append(
+            f"the query returns {len(outer.expressions)} columns; select only the columns the question needs"
+        )
+    changes = []
+    if stars:
+        changes.append(f"expanded {stars} SELECT *")
+    if removed:
+        changes.append(f"removed {removed} unused column(s) from CTEs and subqueries")
+    if not removed:
+        # Expanding stars alone does not reduce the bytes scanned.
+        return sql, [], warnings
+    return _restore_case(pruned, names).sql("bigquery"), changes, warnings
+
+
+def _approx_count_distinct(ast):
+    count = 0
+    for node in list(ast.find_all(exp.Count)):
+        distinct = node.this
+        if isinstance(distinct, exp.Distinct) and len(distinct.expressions) == 1 and not isinstance(node.parent, exp.Window):
+            node.replace(exp.ApproxDistinct(this=distinct.expressions[0].copy()))
+            count += 1
+    return [f"COUNT(DISTINCT) -> APPROX_COUNT_DISTINCT ({count}x)"] if count else []
+
+
+def _quantile_offset(fraction):
+    """Returns (buckets, offset) so that APPROX_QUANTILES(x, buckets)[OFFSET(offset)] estimates the fraction."""
+    for buckets in (100, 1000):
+        offset = fraction * buckets
+        if abs(offset - round(offset)) < 1e-9:
+            return buckets, round(offset)
+    return 1000, round(fraction * 1000)
+
+
+def _approx_quantiles(ast):
+    """Rewrites `SELECT DISTINCT [keys,] PERCENTILE_CONT/DISC(x, q) OVER ([PARTITION BY keys])`
+    into an aggregate query over APPROX_QUANTILES grouped by the partition keys."""
+    changes = []
+    for select in list(ast.find_all(exp.Select)):
+        windows = [
+            p.unalias() for p in select.expressions
+            if isinstance(p.unalias(), exp.Window)
+            and isinstance(p.unalias().this, (exp.PercentileCont, exp.PercentileDisc))
+        ]
+        if not select.args.get("distinct") or not windows or select.args.get("group"):
+            continue
+        partitions = {tuple(e.sql("bigquery") for e in w.args.get("partition_by") or []) for w in windows}
+        if len(partitions) != 1 or any(w.args.get("order") for w in windows):
+            continue
+        keys = windows[0].args.get("partition_by") or []
+        key_sql = {k.sql("bigquery") for k in keys}
+        others = [p for p in select.expressions if p.unalias() not in windows]
+        if any(p.unalias().sql("bigquery") not in key_sql for p in others):
+            continue
+        fractions = [w.this.expression for w in windows]
+        if not all(isinstance(f, exp.Literal) and not f.is_string for f in fractions):
+            continue
+
+        for window in windows:
+            buckets, offset = _quantile_offset(float(window.this.expression.this))
+            window.replace(parse(
+                f"APPROX_QUANTILES({window.this.this.sql('bigquery')}, {buckets})[OFFSET({offset})]"
+            ))
+        select.set("distinct", None)
+        if keys:
+            select.group_by(*[k.copy() for k in keys], copy=False)
+        changes.append(f"PERCENTILE_CONT/DISC -> APPROX_QUANTILES ({len(windows)}x)")
+    return changes
+
+
+def _approx_top_count(ast):
+    """Rewrites `SELECT key, COUNT(*) AS n ... GROUP BY key ORDER BY n DESC LIMIT k` to APPROX_TOP_COUNT."""
+    if not isinstance(ast, exp.Select) or ast.args.get("having") or ast.args.get("distinct"):
+        return ast, []
+    group, order, limit = ast.args.get("group"), ast.args.get("order"), ast.args.get("limit")
+    if not group or not order or not limit or len(group.expressions) != 1 or len(order.expressions) != 1:
+        return ast, []
+    if len(ast.expressions) != 2 or not isinstance(limit.expression, exp.Literal):
+        return ast, []
+    key = group.expressions[0]
+    key_projection = next((p for p in ast.expressions if p.unalias() == key), None)
+    count_projection = next((p for p in ast.expressions if isinstance(p.unalias(), exp.Count)), None)
+    if key_projection is None or count_projection is None:
+        return ast, []
+    counted = count_projection.unalias().this
+    if not (isinstance(counted, exp.Star) or (isinstance(counted, exp.Literal) and counted.this == "1")):
+        return ast, []
+    ordered = order.expressions[0]
+    if not ordered.args.get("desc") or ordered.this not in (count_projection.unalias(), exp.column(count_projection.alias_or_name)):
+        return ast, []
+
+    key_name, count_name = key_projection.alias_or_name, count_projection.alias_or_name
+    inner = ast.copy()
+    for arg in ("group", "order", "limit"):
+        inner.set(arg, None)
+    inner.set("expressions", [exp.func("APPROX_TOP_COUNT", key.copy(), limit.expression.copy())])
+    rewritten = parse(
+        f"SELECT value AS `{key_name}`, `count` AS `{count_name}` "
+        f"FROM UNNEST(({inner.sql('bigquery')})) ORDER BY `{count_name}` DESC"
+    )
+    return rewritten, ["GROUP BY ... ORDER BY COUNT(*) DESC LIMIT k -> APPROX_TOP_COUNT"]
+
+
+def approximate_aggregates(sql):
+    """Rewrites exact aggregates to BigQuery's approximate ones. Returns (sql, changes).
+
+    COUNT(DISTINCT x) becomes APPROX_COUNT_DISTINCT(x), DISTINCT PERCENTILE_CONT/DISC
+    windows become APPROX_QUANTILES, and a top-k frequency query becomes
+    APPROX_TOP_COUNT. The SQL is unchanged if changes is empty.
+    """
+    ast = parse(sql)
+    ast, changes = _approx_top_count(ast)
+    changes += _approx_count_distinct(ast) + _approx_quantiles(ast)
+    if not changes:
+        return sql, []
+    return ast.sql("bigquery"), changes
@@ -1,5 +1,15 @@
+import logging
+import re
+import time
 from google.cloud import bigquery
 import os
+from tools.answers import format_bytes
+
+logger = logging.getLogger(__name__)
+
+# Process-wide schema cache: (project, datasets, allowlist) -> (timestamp, DDL).
+_SCHEMA_CACHE = {}
+SCHEMA_CACHE_TTL_SECONDS = float(os.getenv("SCHEMA_CACHE_TTL_SECONDS", "3600"))
 
 def get_bigquery_schema(dataset_ids, data_project_id, client=None, compute_project_id=None, table_allowlist=None):
     """Retrieves schema and generates DDL with example values for a list of BigQuery datasets."""
@@ -39,14 +49,18 @@ def get_bigquery_schema(dataset_ids, data_project_id, client=None, compute_proje
                             col_def += f" OPTIONS(description='''{escaped_description}''')"
                         column_defs.append(col_def)
 
+                    metadata = _table_metadata(table_obj)
+                    _TABLE_METADATA_CACHE[str(table_ref)] = metadata
                     ddl_statement = (
                         f"CREATE OR REPLACE TABLE `{table_ref}` "
-                        f"(\n{',\n'.join(column_defs)}\n);\n\n"
+                        f"(\n{',\n'.join(column_defs)}\n){render_table_options(metadata)};\n"
+                        f"{render_table_stats(table_ref, metadata)}\n"
                     )
 
                     try:
-                        sample_query = f"SELECT * FROM `{table_ref}` LIMIT 2"
-                        rows = client.query(sample_query).to_dataframe()
+                        # Reading rows through the API is free and, unlike SELECT ... LIMIT,
+                        # neither scans the table nor needs a partition filter.
+                        rows = client.list_rows(table_obj, max_results=2).to_dataframe()
 
                         if not rows.empty:
                             ddl_statement += f"-- Example values for table `{table_ref}`:\n"
@@ -62,11 +76,124 @@ def get_bigquery_schema(dataset_ids, data_project_id, client=None, compute_proje
 
                     all_ddl_statements += ddl_statement
         except Exception as e:
-            print(f"Could not query schema for dataset {dataset_id}: {e}")
+            logger.warning("Could not query schema for dataset %s: %s", dataset_id, e)
             continue
     return all_ddl_statements
 
 
+def get_cached_bigquery_schema(dataset_ids, data_project_id, compute_project_id=None, table_allowlist=None):
+    """Returns get_bigquery_schema output, reusing a cached copy younger than SCHEMA_CACHE_TTL_SECONDS."""
+    key = (data_project_id, tuple(dataset_ids), tuple(table_allowlist or ()))
+    cached = _SCHEMA_CACHE.get(key)
+    if cached and time.monotonic() - cached[0] < SCHEMA_CACHE_TTL_SECONDS:
+        return cached[1]
+
+    ddl_schema = get_bigquery_schema(
+        dataset_ids=dataset_ids,
+        data_project_id=data_project_id,
+        compute_project_id=compute_project_id,
+        table_allowlist=table_allowlist,
+    )
+    if ddl_schema:
+        _SCHEMA_CACHE[key] = (time.monotonic(), ddl_schema)
+    return ddl_schema
+
+
+# Pruning-related table metadata per fully qualified table id, filled by
+# get_bigquery_schema and get_table_metadata.
+_TABLE_METADATA_CACHE = {}
+
+def _table_metadata(table_obj):
+    """Returns the partitioning, clustering, columns and size of a table as a plain dict."""
+    partitioning = None
+    if table_obj.time_partitioning is not None:
+        field = table_obj.time_partitioning.field
+        field_types = {f.name: f.field_type for f in table_obj.schema}
+        partitioning = {
+            "field": field or "_PARTITIONDATE",
+            "field_type": field_types.get(field, "DATE"),
+            "granularity": table_obj.time_partitioning.type_ or "DAY",
+            "require_partition_filter": bool(table_obj.require_partition_filter),
+        }
+    range_partitioning = None
+    if table_obj.range_partitioning is not None:
+        bounds = table_obj.range_partitioning.range_
+        range_partitioning = {
+            "field": table_obj.range_partitioning.field,
+            "start": bounds.start,
+            "end": bounds.end,
+            "interval": bounds.interval,
+        }
+    return {
+        "partitioning": partitioning,
+        "range_partitioning": range_partitioning,
+        "clustering_fields": list(table_obj.clustering_fields or []),
+        "columns": {f.name: f.field_type for f in table_obj.schema},
+        "require_partition_filter": bool(table_obj.require_partition_filter),
+        "num_rows": table_obj.num_rows,
+        "num_bytes": table_obj.num_bytes,
+    }
+
+def get_table_metadata(table_ids, client=None, compute_project_id=None):
+    """Returns {table_id: metadata} (see _table_metadata) for `project.dataset.table` ids.
+
+    Tables that cannot be read are left out.
+    """
+    metadata = {}
+    for table_id in table_ids:
+        if table_id not in _TABLE_METADATA_CACHE:
+            if client is None:
+                client = bigquery.Client(project=compute_project_id)
+            try:
+                _TABLE_METADATA_CACHE[table_id] = _table_metadata(client.get_table(table_id))
+            except Exception as e:
+                logger.warning("Could not read metadata of %s: %s", table_id, e)
+                continue
+        metadata[table_id] = _TABLE_METADATA_CACHE[table_id]
+    return metadata
+
+def get_table_partitioning(table_ids, client=None, compute_project_id=None):
+    """Returns {table_id: partitioning} for time-partitioned tables among `project.dataset.table` ids.
+
+    Each entry has the partition `field` (`_PARTITIONDATE` for ingestion-time
+    partitioning), its `field_type`, `granularity` and `require_partition_filter`.
+    """
+    return {
+        table_id: metadata["partitioning"]
+        for table_id, metadata in get_table_metadata(table_ids, client, compute_project_id).items()
+        if metadata["partitioning"]
+    }
+
+def _partition_expression(partitioning):
+    field, granularity = partitioning["field"], partitioning["granularity"]
+    if field == "_PARTITIONDATE":
+        return field if granularity == "DAY" else f"TIMESTAMP_TRUNC(_PARTITIONTIME, {granularity})"
+    if partitioning["field_type"] == "DATE" and granularity == "DAY":
+        return f"`{field}`"
+    return f"{partitioning['field_type']}_TRUNC(`{field}`, {granularity})"
+
+def render_table_options(metadata):
+    """Renders the PARTITION BY / CLUSTER BY / OPTIONS clauses that follow a CREATE TABLE column list."""
+    clauses = []
+    if metadata["partitioning"]:
+        clauses.append(f"PARTITION BY {_partition_expression(metadata['partitioning'])}")
+    elif metadata["range_partitioning"]:
+        r = metadata["range_partitioning"]
+        clauses.append(
+            f"PARTITION BY RANGE_BUCKET(`{r['field']}`, GENERATE_ARRAY({r['start']}, {r['end']}, {r['interval']}))"
+        )
+    if metadata["clustering_fields"]:
+        clauses.append("CLUSTER BY " + ", ".join(f"`{field}`" for field in metadata["clustering_fields"]))
+    if metadata["require_partition_filter"]:
+        clauses.append("OPTIONS(require_partition_filter=TRUE)")
+    return "".join(f"\n{clause}" for clause in clauses)
+
+def render_table_stats(table_ref, metadata):
+    """Renders a one-line comment with the row count and size of a table."""
+    rows = f"{metadata['num_rows']:,} rows" if metadata["num_rows"] is not None else "unknown rows"
+    return f"-- `{table_ref}`: {rows}, {format_bytes(metadata['num_bytes'])}\n"
+
+
 def list_bigquery_datasets(project_id, client=None):
     """Lists all datasets in a BigQuery project."""
     if client is None:
@@ -84,3 +211,34 @@ def _serialize_value_for_sql(value):
     if isinstance(value, str):
         return f"'{value.replace("'", "''")}'"
     return str(value)
+
+
+def prune_ddl(ddl_schema, sql):
+    """Keeps only the DDL blocks (with their example rows) of tables referenced in the SQL.
+
+    Falls back to the full schema if no table can be matched, e.g. for a query
+    that is too broken to mention any known table.
+    """
+    blocks = re.split(r"(?=^CREATE OR REPLACE TABLE )", ddl_schema, flags=re.MULTILINE)
+    sql_lower = sql.lower()
+    kept = []
+    for block in blocks:
+        match = re.match(r"CREATE OR REPLACE TABLE `([^`]+)`", block)
+        if match and match.group(1).split(".")[-1].lower() in sql_lower:
+            kept.append(block)
+    return "".join(kept) if kept else ddl_schema
+
+
+def ddl_columns(ddl_schema):
+    """Returns {table name: set of column names} from DDL rendered by get_bigquery_schema."""
+    tables = {}
+    for block in re.split(r"(?=^CREATE OR REPLACE TABLE )", ddl_schema, flags=re.MULTILINE):
+        match = re.match(r"CREATE OR REPLACE TABLE `([^`]+)`", block)
+        if match:
+            tables[match.group(1).split(".")[-1]] = set(re.findall(r"^  `([^`]+)` ", block, flags=re.MULTILINE))
+    return tables
+
+
+def ddl_table_ids(ddl_schema):
+    """Returns the full `project.dataset.table` ids of the tables in DDL rendered by get_bigquery_schema."""
+    return re.findall(r"^CREATE OR REPLACE TABLE `([^`]+)`", ddl_schema, flags=re.MULTILINE)
@@ -1,8 +1,9 @@
 import re
 from google.cloud import bigquery
+from tools import deadline
 
 def enforce(sql_string: str, compute_project_id: str):
-    """Enforces that the SQL query is read-only and valid."""
+    """Enforces that the SQL query is read-only and valid. Returns the dry-run job."""
     # More restrictive check for BigQuery - disallow DML and DDL
     if re.search(
         r"(?i)\b(update|delete|drop|insert|create|alter|truncate|merge)\b", sql_string
@@ -10,6 +11,13 @@ def enforce(sql_string: str, compute_project_id: str):
         raise ValueError("Invalid SQL: Contains disallowed DML/DDL operations.")
 
     # Use BigQuery's dry-run feature to validate the query without executing it
+    return dry_run(sql_string, compute_project_id)  # This will raise an exception if the SQL is invalid
+
+def dry_run(sql_string: str, compute_project_id: str):
+    """Dry-runs the query and returns the job; `total_bytes_processed` holds the scan estimate.
+
+    The request is bounded by the dry-run share of the question deadline.
+    """
     client = bigquery.Client(project=compute_project_id)
     job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
-    client.query(sql_string, job_config=job_config)  # This will raise an exception if the SQL is invalid
+    return client.query(sql_string, job_config=job_config, timeout=deadline.stage_timeout("dry_run"))
@@ -0,0 +1,274 @@
+import datetime
+import os
+import threading
+import time
+import sqlglot
+from sqlglot import exp
+from tools.rewriter import table_id
+
+# Results per (query template, day). Days within WINDOW_CACHE_STALE_DAYS of today are
+# always refetched because recent hourly data is still being loaded.
+WINDOW_CACHE_TTL_SECONDS = float(os.getenv("WINDOW_CACHE_TTL_SECONDS", "86400"))
+WINDOW_CACHE_STALE_DAYS = int(os.getenv("WINDOW_CACHE_STALE_DAYS", "2"))
+WINDOW_CACHE_MAX_TEMPLATES = int(os.getenv("WINDOW_CACHE_MAX_TEMPLATES", "64"))
+
+_INTERVAL_DAYS = {"DAY": 1, "WEEK": 7}
+
+_cache = {}  # template key -> {day: (fetched_at, rows)}
+_lock = threading.Lock()
+
+
+class NotDecomposable(Exception):
+    """The query cannot be answered from per-day buckets."""
+
+
+class WindowQuery:
+    """A query with a day-granular time range that can be split into per-day buckets."""
+
+    def __init__(self, ast, time_expr, start, end, bucket_column, order_by, limit, offset=0):
+        self.ast = ast  # Query without the time predicate, ORDER BY, LIMIT and OFFSET.
+        self.time_expr = time_expr
+        self.start = start
+        self.end = end  # Inclusive.
+        self.bucket_column = bucket_column
+        self.order_by = order_by  # [(output column, descending)]
+        self.limit = limit
+        self.offset = offset
+        self.key = ast.sql("bigquery") + f" -- bucket: {time_expr.sql('bigquery')}"
+
+    def sql_for_range(self, first_day, last_day):
+        """Returns the query restricted to the days first_day..last_day (inclusive)."""
+        ast = self.ast.copy()
+        ast.where(
+            exp.Between(
+                this=self.time_expr.copy(),
+                low=_date_literal(first_day),
+                high=_date_literal(last_day),
+            ),
+            copy=False,
+        )
+        return ast.sql("bigquery")
+
+
+def _date_literal(day):
+    return exp.cast(exp.Literal.string(day.isoformat()), exp.DataType.Type.DATE)
+
+
+def _today():
+    # CURRENT_DATE() in BigQuery defaults to UTC.
+    return datetime.datetime.now(datetime.timezone.utc).date()
+
+
+def _evaluate_date(node):
+    """Evaluates a constant date expression; raises NotDecomposable for anything else."""
+    if isinstance(node, exp.Literal) and node.is_string:
+        try:
+            return datetime.date.fromisoformat(node.this)
+        except ValueError:
+            raise NotDecomposable(f"Not a date literal: {node.sql('bigquery')}")
+    if isinstance(node, (exp.Cast, exp.Date)) and (
+        not isinstance(node, exp.Cast) or node.to.this == exp.DataType.Type.DATE
+    ):
+        return _evaluate_date(node.this)
+    if isinstance(node, exp.CurrentDate):
+        return _today()
+    if isinstance(node, (exp.DateSub, exp.DateAdd)):
+        unit = node.args.get("unit")
+        unit = unit.name.upper() if unit else "DAY"
+        amount = node.expression
+        if unit not in _INTERVAL_DAYS or not isinstance(amount, exp.Literal):
+            raise NotDecomposable(f"Unsupported interval in {node.sql('bigquery')}")
+        days = int(amount.this) * _INTERVAL_DAYS[unit]
+        base = _evaluate_date(node.this)
+        return base - datetime.timedelta(days=days) if isinstance(node, exp.DateSub) else base + datetime.timedelta(days=days)
+    raise NotDecomposable(f"Not a constant date: {node.sql('bigquery')}")
+
+
+def _conjuncts(node):
+    if isinstance(node, exp.And):
+        return _conjuncts(node.this) + _conjuncts(node.expression)
+    if isinstance(node, exp.Paren):
+        return _conjuncts(node.this)
+    return [node]
+
+
+def _range_bounds(predicate):
+    """Returns (time expression, start, end) for a day-granular range predicate, or None."""
+    if isinstance(predicate, exp.Between):
+        try:
+            return predicate.this, _evaluate_date(predicate.args["low"]), _evaluate_date(predicate.args["high"])
+        except NotDecomposable:
+            return None
+    bounds = {exp.GTE: (0, None), exp.GT: (1, None), exp.LTE: (None, 0), exp.LT: (None, -1), exp.EQ: (0, 0)}
+    if type(predicate) not in bounds:
+        return None
+    try:
+        value = _evaluate_date(predicate.expression)
+    except NotDecomposable:
+        return None
+    low, high = bounds[type(predicate)]
+    start = value + datetime.timedelta(days=low) if low is not None else None
+    end = value + datetime.timedelta(days=high) if high is not None else None
+    return predicate.this, start, end
+
+
+def _check_date_typed(ast, time_expr, column_types):
+    """Raises NotDecomposable unless the time expression is a DATE, which the day bounds compare with.
+
+    DATE(...) and CAST(... AS DATE) are; a bare column is if `column_types`
+    (table id -> {column: BigQuery type}) says so. TIMESTAMP and DATETIME columns
+    are not: BigQuery rejects the DATE bounds, or their values are not days.
+    """
+    if isinstance(time_expr, exp.Date):
+        return
+    if isinstance(time_expr, (exp.Cast, exp.TryCast)) and time_expr.to.is_type("date"):
+        return
+    if not isinstance(time_expr, exp.Column):
+        raise NotDecomposable(f"Cannot tell that {time_expr.sql('bigquery')} is a DATE.")
+    tables = {table.alias_or_name: table for table in ast.find_all(exp.Table)}
+    if time_expr.table:
+        tables = {time_expr.table: tables[time_expr.table]} if time_expr.table in tables else {}
+    data_project, dataset = os.getenv("BQ_DATA_PROJECT_ID"), os.getenv("BQ_DATASET_ID")
+    types = set()
+    for table in tables.values():
+        columns = {name.lower(): type_ for name, type_ in (column_types(table_id(table, data_project, dataset)) or {}).items()}
+        if time_expr.name.lower() in columns:
+            types.add(columns[time_expr.name.lower()].upper())
+    if types != {"DATE"}:
+        raise NotDecomposable(f"{time_expr.sql('bigquery')} is not a DATE column.")
+
+
+def analyze(sql, column_types=None):
+    """Splits a query into a per-day bucketable WindowQuery; raises NotDecomposable otherwise.
+
+    Only a single top-level SELECT qualifies: no CTEs, subqueries, set operations or
+    window functions, a closed day range on one DATE expression in the WHERE clause, and
+    that expression in the output (and in the GROUP BY for aggregate queries), so every
+    result row belongs to exactly one day. ORDER BY, LIMIT and OFFSET are re-applied
+    locally over the whole range. A LIMIT on a non-aggregate query does not qualify:
+    each day would be fetched in full. With BQ_ENFORCE_QUERY_LIMITS every executed
+    query has a LIMIT, so then only aggregate queries use the cache.
+
+    `column_types(table_id)` returns {column: BigQuery type} of a table and is used
+    to check, before anything is queried, that a bare time column is a DATE.
+    """
+    try:
+        ast = sqlglot.parse_one(sql, read="bigquery")
+    except sqlglot.errors.SqlglotError as e:
+        raise NotDecomposable(str(e))
+    if not isinstance(ast, exp.Select) or ast.find(exp.CTE):
+        raise NotDecomposable("Only a single SELECT statement is supported.")
+    if any(select is not ast for select in ast.find_all(exp.Select)) or ast.find(exp.Window):
+        raise NotDecomposable("Subqueries and window functions are not supported.")
+    where = ast.args.get("where")
+    if not where:
+        raise NotDecomposable("No time range predicate.")
+
+    time_expr, start, end, remaining = None, None, None, []
+    for predicate in _conjuncts(where.this):
+        bounds = _range_bounds(predicate)
+        if bounds and (time_expr is None or bounds[0] == time_expr):
+            time_expr = bounds[0]
+            start = bounds[1] if bounds[1] is not None else start
+            end = bounds[2] if bounds[2] is not None else end
+        else:
+            remaining.append(predicate)
+    if time_expr is None or start is None or end is None or start > end:
+        raise NotDecomposable("No closed day range in the WHERE clause.")
+
+    outputs = {select.unalias(): select.alias_or_name for select in ast.expressions}
+    bucket_column = outputs.get(time_expr)
+    if bucket_column is None:
+        raise NotDecomposable(f"{time_expr.sql('bigquery')} is not in the SELECT list.")
+    if column_types is not None:
+        _check_date_typed(ast, time_expr, column_types)
+    aggregate = ast.find(exp.AggFunc) is not None
+    if aggregate:
+        group = ast.args.get("group")
+        if not group or time_expr not in group.expressions:
+            raise NotDecomposable(f"Aggregates are not grouped by {time_expr.sql('bigquery')}.")
+
+    order_by = []
+    output_names = set(outputs.values())
+    for ordered in (ast.args.get("order").expressions if ast.args.get("order") else []):
+        key = ordered.this
+        name = outputs.get(key) or (key.name if isinstance(key, exp.Column) else None)
+        if name not in output_names:
+            raise NotDecomposable(f"Cannot order locally by {key.sql('bigquery')}.")
+        order_by.append((name, bool(ordered.args.get("desc"))))
+    limit, offset = ast.args.get("limit"), ast.args.get("offset")
+    if limit and not aggregate:
+        raise NotDecomposable("LIMIT on a non-aggregate query would fetch every row of every day.")
+    limit = int(limit.expression.this) if limit else None
+    offset = int(offset.expression.this) if offset else 0
+
+    template = ast.copy()
+    template.set("where", None)
+    template.set("order", None)
+    template.set("limit", None)
+    template.set("offset", None)
+    for predicate in remaining:
+        template.where(predicate.copy(), copy=False)
+    return WindowQuery(template, time_expr.copy(), start, end, bucket_column, order_by, limit, offset)
+
+
+def _missing_ranges(days):
+    """Groups sorted days into contiguous (first, last) ranges."""
+    ranges = []
+    for day in days:
+        if ranges and day - ranges[-1][1] == datetime.timedelta(days=1):
+            ranges[-1][1] = day
+        else:
+            ranges.append([day, day])
+    return ranges
+
+
+def _sort_key(value):
+    # BigQuery puts NULLs first in ascending and last in descending order.
+    return (value is not None, value)
+
+
+def execute(sql, run_query, column_types=None):
+    """Answers a time-ranged query from per-day buckets, querying only missing or stale days.
+
+    `run_query(sql)` must return a list of dict rows; `column_types` is passed to
+    analyze. Returns (rows, stats) or raises NotDecomposable if the query does not
+    split cleanly into days.
+    """
+    window = analyze(sql, column_types)
+    days = [window.start + datetime.timedelta(days=i) for i in range((window.end - window.start).days + 1)]
+    now = time.time()
+    fresh_until = _today() - datetime.timedelta(days=WINDOW_CACHE_STALE_DAYS)
+    with _lock:
+        buckets = _cache.get(window.key, {})
+        missing = [
+            day for day in days
+            if day not in buckets or day > fresh_until or now - buckets[day][0] > WINDOW_CACHE_TTL_SECONDS
+        ]
+
+    fetched = {}
+    for first_day, last_day in _missing_ranges(missing):
+        for day in range((last_day - first_day).days + 1):
+            fetched[first_day + datetime.timedelta(days=day)] = []
+        for row in run_query(window.sql_for_range(first_day, last_day)):
+            day = row[window.bucket_column]
+            if type(day) is not datetime.date:
+                # DATETIME/TIMESTAMP values: the day range is not the column's granularity.
+                raise NotDecomposable(f"{window.bucket_column} is not a DATE column.")
+            fetched[day].append(row)
+
+    with _lock:
+        buckets = dict(_cache.get(window.key, {}))
+        buckets.update({day: (now, rows) for day, rows in fetched.items()})
+        _cache[window.key] = buckets
+        while len(_cache) > WINDOW_CACHE_MAX_TEMPLATES:
+            _cache.pop(next(iter(_cache)))
+
+    rows = [row for day in days for row in buckets[day][1]]
+    for name, descending in reversed(window.order_by):
+        rows.sort(key=lambda row: _sort_key(row[name]), reverse=descending)
+    rows = rows[window.offset:]
+    if window.limit is not None:
+        rows = rows[: window.limit]
+    stats = {"days": len(days), "days_queried": len(missing), "days_from_cache": len(days) - len(missing)}
+    return rows, stats